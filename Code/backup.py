@@ -0,0 +1,99 @@
+import os
+import struct
+from encryption import KDF_LEGACY, KDF_PBKDF2_SHA256, KDF_PBKDF2_SHA512, SEAL_OVERHEAD, Sealer, hmac_sha256
+from vault import VAULT_FILE, JOURNAL_FILE, restore_vault
+
+BACKUP_FILE = "backup.g8k"
+BACKUP_MAGIC = b"G8KB"
+BACKUP_VERSION = 1
+
+# Header: magic, format version, KDF id, KDF iterations, salt and the
+# length of the vault image that follows. The image is a copy of the
+# vault file sealed as one encryption.Sealer stream (nonce, AES-CTR
+# ciphertext, tag) with the header as associated data, so not even the
+# layout of the vault is readable without the key.
+BACKUP_HEADER_FORMAT = "<4sBBI16sI"
+BACKUP_HEADER_SIZE = struct.calcsize(BACKUP_HEADER_FORMAT)
+
+BACKUP_CHUNK_SIZE = 256
+
+
+def _backup_key(key):
+    # Separate key for backups, the vault key itself only ever drives AES
+    return hmac_sha256(key, b"G8KEEPER backup")
+
+
+def _read_header(file):
+    header = file.read(BACKUP_HEADER_SIZE)
+    if len(header) != BACKUP_HEADER_SIZE:
+        raise ValueError("Truncated backup")
+    magic, version, kdf, iterations, salt, length = struct.unpack(BACKUP_HEADER_FORMAT, header)
+    if magic != BACKUP_MAGIC:
+        raise ValueError("Not a backup file")
+    if version != BACKUP_VERSION:
+        raise ValueError(f"Unsupported backup version: {version}")
+    if kdf not in (KDF_PBKDF2_SHA256, KDF_PBKDF2_SHA512):
+        raise ValueError(f"Unsupported key derivation: {kdf}")
+    return kdf, iterations, salt, length, header
+
+
+def _open_image(key, path):
+    # Authenticate the backup at path. Returns a file-like object reading
+    # the plain vault image, the underlying file to close and the image
+    # length.
+    file = open(path, "rb")
+    try:
+        _, _, _, length, header = _read_header(file)
+        if os.stat(path)[6] != BACKUP_HEADER_SIZE + length + SEAL_OVERHEAD:
+            raise ValueError("Truncated backup")
+        return Sealer(_backup_key(key)).open_stream(file, length, header, BACKUP_CHUNK_SIZE), file, length
+    except Exception:
+        file.close()
+        raise
+
+
+def export_backup(entries, key, kdf_params, path=BACKUP_FILE, vault_path=VAULT_FILE):
+    """
+    Seal the vault behind the PasswordEntries session entries into a
+    single file together with the (kdf, iterations, salt) needed to
+    unlock it, streaming the vault in chunks. Returns the number of
+    exported entries.
+    """
+    entries.flush()
+    kdf, iterations, salt = kdf_params
+    if kdf == KDF_LEGACY:
+        kdf = KDF_PBKDF2_SHA256  # Same derivation, the salt is stored here
+    length = os.stat(vault_path)[6]
+    header = struct.pack(BACKUP_HEADER_FORMAT, BACKUP_MAGIC, BACKUP_VERSION, kdf, iterations, salt, length)
+    temp_path = path + ".tmp"
+    with open(vault_path, "rb") as source, open(temp_path, "wb") as target:
+        target.write(header)
+        Sealer(_backup_key(key)).seal_stream(source, target, length, header, BACKUP_CHUNK_SIZE)
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+    os.rename(temp_path, path)
+    return len(entries)
+
+
+def read_backup_header(path=BACKUP_FILE):
+    """
+    Return (kdf, iterations, salt) of a backup, the key to restore it has
+    to be derived with these.
+    """
+    with open(path, "rb") as file:
+        return _read_header(file)[:3]
+
+
+def restore_backup(key, path=BACKUP_FILE, vault_path=VAULT_FILE, journal_path=JOURNAL_FILE):
+    """
+    Replace the vault with the one in a backup. The whole file is
+    authenticated before anything is written, then the image is decrypted
+    and streamed into a new vault generation. Returns the new generation.
+    """
+    image, file, length = _open_image(key, path)
+    try:
+        return restore_vault(image, length, vault_path, journal_path)
+    finally:
+        file.close()
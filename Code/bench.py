@@ -0,0 +1,95 @@
+import gc
+import sys
+import time
+from encryption import HASH_ENGINE, HASH_ENGINE_512, Sealer, decrypt_password, encrypt_password, hmac_sha256, hmac_sha512, pbkdf2_hmac
+
+# Benchmarks for encryption.py. The same code runs on the device (import
+# bench; bench.main() from the REPL) and on a PC through
+# Tools/bench_host.py, and prints the same CSV either way, so results
+# captured over serial can be compared with host runs line by line.
+
+# Minimum time each case is repeated for
+BENCH_MIN_TIME_MS = 1000
+
+HMAC_SIZES = (16, 64, 256, 1024)
+PBKDF2_ITERATIONS = (10, 100)
+PASSWORD_SIZES = (8, 32, 128)
+RECORD_SIZES = (8, 32, 128)
+
+# name and param identify a case and rate is param units per second (bytes
+# hashed or encrypted, or PBKDF2 iterations). The last column is named
+# after what the alloc function of the run measures.
+CSV_COLUMNS = "name,param,unit,calls,ops_per_s,rate"
+
+BENCH_KEY = bytes(range(16))
+BENCH_SALT = bytes(range(16, 32))
+
+
+# Bytes allocated by one call of fn. The collector is off during the call,
+# so the growth of gc.mem_alloc() is everything fn allocated.
+def gc_alloc(fn):
+    gc.collect()
+    gc.disable()
+    try:
+        before = gc.mem_alloc()
+        fn()
+        return gc.mem_alloc() - before
+    finally:
+        gc.enable()
+
+
+# Call fn until min_time_ms have passed, returns (calls, elapsed_ns)
+def time_calls(fn, min_time_ms):
+    limit = min_time_ms * 1000000
+    calls = 0
+    start = time.monotonic_ns()
+    elapsed = 0
+    while elapsed < limit or not calls:
+        fn()
+        calls += 1
+        elapsed = time.monotonic_ns() - start
+    return calls, elapsed
+
+
+# (name, param, unit, fn) for every case, inputs are prepared up front so
+# only the call itself is measured
+def cases():
+    for size in HMAC_SIZES:
+        message = bytes(size)
+        yield "hmac_sha256", size, "B", lambda message=message: hmac_sha256(BENCH_KEY, message)
+        yield "hmac_sha512", size, "B", lambda message=message: hmac_sha512(BENCH_KEY, message)
+    for iterations in PBKDF2_ITERATIONS:
+        yield "pbkdf2_hmac", iterations, "iter", lambda iterations=iterations: pbkdf2_hmac("sha256", BENCH_KEY, BENCH_SALT, iterations)
+        yield "pbkdf2_hmac_sha512", iterations, "iter", lambda iterations=iterations: pbkdf2_hmac("sha512", BENCH_KEY, BENCH_SALT, iterations)
+    for size in PASSWORD_SIZES:
+        password = "p" * size
+        encrypted = encrypt_password(BENCH_KEY, password)
+        yield "encrypt_password", size, "B", lambda password=password: encrypt_password(BENCH_KEY, password)
+        yield "decrypt_password", size, "B", lambda encrypted=encrypted: decrypt_password(BENCH_KEY, encrypted)
+    sealer = Sealer(BENCH_KEY)
+    for size in RECORD_SIZES:
+        data = bytes(size)
+        sealed = bytes(sealer.seal(data))
+        yield "sealer_seal", size, "B", lambda data=data: sealer.seal(data)
+        yield "sealer_open", size, "B", lambda sealed=sealed: sealer.open(sealed)
+
+
+def run(min_time_ms=BENCH_MIN_TIME_MS, names=None, alloc=gc_alloc, report=print, alloc_column="alloc_bytes"):
+    """
+    Run the cases whose name is in names (all if None) and report one CSV
+    line per case. alloc measures the memory of one call, alloc_column
+    names the column it goes in.
+    """
+    report(f"# bench {sys.implementation.name} {sys.platform} hash={HASH_ENGINE},{HASH_ENGINE_512} alloc={alloc.__name__}")
+    report(f"{CSV_COLUMNS},{alloc_column}")
+    for name, param, unit, fn in cases():
+        if names is not None and name not in names:
+            continue
+        allocated = alloc(fn)
+        calls, elapsed = time_calls(fn, min_time_ms)
+        ops_per_s = calls * 1000000000 / elapsed
+        report(f"{name},{param},{unit},{calls},{ops_per_s:.2f},{ops_per_s * param:.0f},{allocated}")
+
+
+def main():
+    run()
@@ -9,9 +9,16 @@ from adafruit_hid.keyboard_layout_us import KeyboardLayoutUS
 import random
 import adafruit_ds3231
 import os
+from profiler import profiled, record_span, span_summary, dump_spans, clear_spans
 
 # Constants
-PATTERN_LENGTH = 5
+# Unlock patterns are any of the five directions, UP/DOWN/LEFT/RIGHT and
+# CLICK, pressed in turn and submitted with SET. New vaults need at least
+# PATTERN_MIN_LENGTH presses (5^8, about 390,000 patterns), older ones
+# keep the pattern they were made with.
+PATTERN_BUTTONS = (("UP", "up"), ("DOWN", "down"), ("LEFT", "left"), ("RIGHT", "right"), ("CLICK", "click"))
+PATTERN_MIN_LENGTH = 8
+PATTERN_MAX_LENGTH = 16
 character_sets = [
     "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz",
     "0123456789",
@@ -19,7 +26,9 @@ character_sets = [
 ]
 MAX_PASSWORD_LENGTH = 5
 PASSWORDS_FILE = "passwords.csv"
-LOCK_SCREEN, MAIN_MENU, VIEW_PASSWORDS, ADD_PASSWORD, GENERATE_PASSWORD, RTC_MENU, RTC_SET_TIME, RTC_CHECK_TIME, RTC_CHECK_STATUS, ENCRYPTION_MENU, ENCRYPT_FILE, DECRYPT_FILE, TEST_ENCRYPTION = range(13)
+LOCK_SCREEN, MAIN_MENU, VIEW_PASSWORDS, ADD_PASSWORD, GENERATE_PASSWORD, RTC_MENU, RTC_SET_TIME, RTC_CHECK_TIME, RTC_CHECK_STATUS, ENCRYPTION_MENU, ENCRYPT_FILE, DECRYPT_FILE, TEST_ENCRYPTION, SEARCH_PASSWORDS, UNLOCKING, DIAGNOSTICS = range(16)
+MENU_ITEM_COUNT = 10
+SEARCH_RESULT_LINES = 3
 
 # Button pins
 BUTTON_PINS = {
@@ -69,15 +78,18 @@ current_screen = LOCK_SCREEN
 selected_menu_item = 0
 current_password_index = 0
 reset_button_press_count = 0
-user_input = [False] * PATTERN_LENGTH
-pattern = [True, False, True, False, True]  # Example pattern "UDUDU" (True, False, True, False, True) last high to select
+user_input = [None] * PATTERN_MAX_LENGTH  # Directions entered on the lock screen
 user_input_index = 0
 password_input = ""
 current_set = 0
 character_position = 0
 passwords_data = []
+search_input = ""
+search_results = ([], 0)
+selected_encryption_item = 0
 
 # Define SendStringHID function
+@profiled("SendStringHID")
 def SendStringHID(string):
     if keyboard_layout:
         keyboard_layout.write(string)
@@ -98,14 +110,11 @@ def draw_loading_screen():
         oled.text("." * (i + 1), 90, 30, 1)
         oled.show()
 
+@profiled("draw_lock_screen")
 def draw_lock_screen():
     """
     Draw the lock screen on the OLED display with centered time above "Device Locked".
     """
-    global user_input_index
-    
-    print(f"Drawing lock screen. user_input_index: {user_input_index}")  # Debug print
-
     oled.fill(0)
     
     # Display current time
@@ -115,14 +124,28 @@ def draw_lock_screen():
     time_x = (128 - time_width) // 2
     oled.text(time_str, time_x, 5, 1)
     
-    oled.text("Device Locked", 10, 20, 1)
-    oled.text("Enter pattern:", 10, 35, 1)
+    if isinstance(passwords_data, PasswordEntries):
+        oled.text("Change pattern", 10, 20, 1)  # Converted legacy vault
+    else:
+        oled.text("Device Locked", 10, 20, 1)
+    if not enrolling:
+        oled.text("Pattern + SET:", 10, 35, 1)
+    elif enroll_pattern is None:
+        oled.text("New pattern+SET:", 0, 35, 1)
+    else:
+        oled.text("Repeat + SET:", 10, 35, 1)
     
     for i in range(user_input_index):
-        oled.text("*", 10 + i * 10, 50, 1)
+        oled.text("*", 6 + i * 7, 50, 1)
     
     oled.show()
 
+def draw_lockout():
+    oled.fill(0)
+    center_text("Too many attempts", 16)
+    center_text(f"Try again in {unlock_not_before - rtc_seconds()}s", 36)
+    oled.show()
+
 def update_lock_screen_time():
     current_time = rtc.datetime
     time_str = f"{current_time.tm_hour:02d}:{current_time.tm_min:02d}"
@@ -136,43 +159,31 @@ def update_lock_screen_time():
     
     
 def handle_lock_screen_input():
-    global user_input_index, current_screen
+    for button, direction in PATTERN_BUTTONS:
+        if not BUTTON_PINS[button].value:
+            if user_input_index < PATTERN_MAX_LENGTH:
+                record_user_input(direction)
+            # One press is one direction however long it is held
+            while not BUTTON_PINS[button].value:
+                time.sleep(0.01)
+            break
+    submitted = BUTTON_PINS["SET"].value == 0
 
-    if not BUTTON_PINS["UP"].value:
-        print("UP button pressed")  # Debug print
-        record_user_input(True)
-    elif not BUTTON_PINS["DOWN"].value:
-        print("DOWN button pressed")  # Debug print
-        record_user_input(False)
-
-    print(f"Current user_input_index: {user_input_index}")  # Debug print
-
-    if user_input_index == PATTERN_LENGTH:
-        print("Pattern length reached")  # Debug print
-        if check_pattern():
-            print("Correct pattern entered")  # Debug print
-            decrypt_file()  # Decrypt the file when unlocking
-            current_screen = MAIN_MENU
-            reset_user_input()
-        else:
-            print("Incorrect pattern")  # Debug print
-            reset_user_input()
+    if rtc_seconds() < unlock_not_before:
+        reset_user_input()  # Patterns are ignored until the delay is over
+        draw_lockout()
+        return
+
+    if submitted and user_input_index:
+        # Nothing on the device knows the pattern, the key derived from
+        # what was entered is checked against the vault header instead
+        start_unlock(user_input[:user_input_index])  # The key is derived step by step by the main loop
+        reset_user_input()
+        time.sleep(0.2)  # Debounce delay
+        return
     
     draw_lock_screen()
 
-def load_passwords():
-    try:
-        with open(PASSWORDS_FILE, "r") as file:
-            return [line.strip().split(',') for line in file]
-    except Exception as e:
-        print("Error loading passwords:", e)
-        return []
-    
-def save_passwords(passwords_data):
-    with open(PASSWORDS_FILE, "w") as file:
-        for entry in passwords_data:
-            file.write(','.join(entry) + '\n')
-            
 def display_password_entry(website, username, password):
     oled.fill(0)
     oled.text(website, 5, 10, 1)
@@ -180,9 +191,10 @@ def display_password_entry(website, username, password):
     oled.text(password, 5, 50, 1)
     oled.show()
 
+@profiled("draw_main_menu")
 def draw_main_menu():
     oled.fill(0)
-    for i in range(selected_menu_item, min(selected_menu_item + 4, 8)):
+    for i in range(selected_menu_item, min(selected_menu_item + 4, MENU_ITEM_COUNT)):
         menu_item_text = f" {get_menu_text(i)}"
         oled.text(menu_item_text, -3, 10 + (i - selected_menu_item) * 20, 1)  # Adding '1' as the color argument for white text
 
@@ -199,10 +211,9 @@ def center_text(text, y, max_width=128):
     x = (max_width - text_width) // 2
     oled.text(text, x, y, 1)
 
+@profiled("draw_view_passwords")
 def draw_view_passwords():
-    global passwords_data
-    if not passwords_data:
-        passwords_data = load_and_decrypt_passwords()
+    passwords_data = get_passwords()
 
     oled.fill(0)
     if not passwords_data:
@@ -214,9 +225,9 @@ def draw_view_passwords():
         oled.text(f"{current_password_index + 1}/{len(passwords_data)}", 0, 0, 1)
         
         # Display current password details (centered)
-        center_text(entry[0], 8)  # Website
-        center_text(entry[1], 24)  # Username
-        center_text(entry[2], 40)  # Password
+        center_text(entry.site, 8)  # Website
+        center_text(entry.username, 24)  # Username
+        center_text(entry.password, 40)  # Password
         
         # Display navigation hints
         oled.text("^v:Nav <:Back >:Type", 0, 56, 1)
@@ -234,7 +245,7 @@ def draw_password_detail():
     oled.text("Password:", 0, 0, 1)
     
     # Split password into multiple lines if necessary
-    password = entry[2]
+    password = entry.password
     max_chars_per_line = 16
     for i in range(0, len(password), max_chars_per_line):
         line = password[i:i+max_chars_per_line]
@@ -250,9 +261,10 @@ def draw_password_detail():
             break
         elif BUTTON_PINS["RESET"].value == 0:
             initialize_usb_hid()
-            SendStringHID(entry[2])
+            SendStringHID(entry.password)
             time.sleep(0.2)  # Debounce delay
 
+@profiled("draw_add_password")
 def draw_add_password():
     oled.fill(0)
     oled.text("Enter password:", 5, 10, 1) 
@@ -278,6 +290,7 @@ def get_current_character():
     current_char_index = (character_position) % len(character_sets[current_set])
     return character_sets[current_set][current_char_index]
 
+@profiled("draw_generate_password")
 def draw_generate_password():
     oled.fill(0)
     oled.text("Length: 12", 10, 10, 1)
@@ -338,6 +351,8 @@ def get_menu_text(menu_item):
         5: "Lock Device",
         6: "Encryption",
         7: "Start Encryption",
+        8: "Search",
+        9: "Diagnostics",
     }
     return switcher.get(menu_item, "")
 
@@ -363,6 +378,11 @@ def handle_selected_menu_item():
         current_screen = ENCRYPTION_MENU
     elif selected_menu_item == 7:
         current_screen = TEST_ENCRYPTION
+    elif selected_menu_item == 8:
+        current_screen = SEARCH_PASSWORDS
+        set_search_input("")
+    elif selected_menu_item == 9:
+        current_screen = DIAGNOSTICS
 
     # Remove this line as it's preventing the screen from changing
     if BUTTON_PINS["SET"].value == 0:
@@ -383,12 +403,65 @@ def handle_view_passwords_input():
         time.sleep(0.1)  # Debounce delay
     elif BUTTON_PINS["RIGHT"].value == 0:  # Changed from RESET to RIGHT
         initialize_usb_hid()
-        SendStringHID(passwords_data[current_password_index][2])
+        SendStringHID(passwords_data[current_password_index].password)
         time.sleep(0.1)  # Debounce delay
 
     draw_view_passwords()  # Redraw the screen after each input
 
 
+def set_search_input(text):
+    global search_input, search_results
+    search_input = text
+    entries = get_passwords()
+    if isinstance(entries, PasswordEntries):
+        search_results = entries.search(search_input, SEARCH_RESULT_LINES)
+    else:
+        search_results = ([], 0)
+
+@profiled("draw_search_passwords")
+def draw_search_passwords():
+    oled.fill(0)
+    matches, hits = search_results
+    oled.text(f"Find:{search_input}", 0, 0, 1)
+    oled.text(get_current_character(), 122, 0, 1)
+    for i, index in enumerate(matches):
+        site, username = passwords_data.name(index)
+        oled.text(truncate_text(f"{site} {username}", 21), 0, 14 + i * 12, 1)
+    if not matches:
+        center_text("No matches", 26)
+    oled.text(f"{hits} hits", 0, 48, 1)
+    oled.text("^v:Chr >:Add <:Del", 0, 56, 1)
+    oled.show()
+
+def handle_search_passwords_input():
+    global current_screen, current_password_index
+
+    if not BUTTON_PINS["UP"].value:
+        cycle_next_character()
+        time.sleep(0.1)  # Debounce delay
+    elif not BUTTON_PINS["DOWN"].value:
+        cycle_previous_character()
+        time.sleep(0.1)  # Debounce delay
+    elif not BUTTON_PINS["RIGHT"].value:
+        set_search_input(search_input + get_current_character())
+        time.sleep(0.2)  # Debounce delay
+    elif not BUTTON_PINS["LEFT"].value:
+        set_search_input(search_input[:-1])
+        time.sleep(0.2)  # Debounce delay
+    elif BUTTON_PINS["RESET"].value == 0:
+        switch_to_next_set()
+        time.sleep(0.2)  # Debounce delay
+    elif not BUTTON_PINS["CLICK"].value:
+        # Jump to the first match in the View Passwords screen
+        if search_results[0]:
+            current_password_index = search_results[0][0]
+            current_screen = VIEW_PASSWORDS
+        time.sleep(0.2)  # Debounce delay
+
+    if BUTTON_PINS["SET"].value == 0:
+        go_to_main_menu()
+
+
 def record_user_input(value):
     global user_input_index
     user_input[user_input_index] = value
@@ -397,23 +470,17 @@ def record_user_input(value):
 def reset_user_input():
     global user_input_index
     user_input_index = 0
-    for i in range(PATTERN_LENGTH):
-        user_input[i] = False
-
-def check_pattern():
-    for i in range(PATTERN_LENGTH):
-        if user_input[i] != pattern[i]:
-            return False
-    return True
+    for i in range(PATTERN_MAX_LENGTH):
+        user_input[i] = None
 
 def handle_main_menu_input():
     global selected_menu_item, reset_button_press_count, current_screen
 
     if not BUTTON_PINS["UP"].value:
-        selected_menu_item = (selected_menu_item - 1) % 8
+        selected_menu_item = (selected_menu_item - 1) % MENU_ITEM_COUNT
         time.sleep(0.1)  # Debounce delay
     elif not BUTTON_PINS["DOWN"].value:
-        selected_menu_item = (selected_menu_item + 1) % 8
+        selected_menu_item = (selected_menu_item + 1) % MENU_ITEM_COUNT
         time.sleep(0.1)  # Debounce delay
 
     if not BUTTON_PINS["CLICK"].value:
@@ -448,8 +515,7 @@ def handle_add_password_input():
             if confirm_character():
                 if len(password_input) == MAX_PASSWORD_LENGTH:
                     new_password_entry = [password_input] + [get_current_character() for _ in range(2)]
-                    passwords_data.append(new_password_entry)
-                    save_passwords(passwords_data)
+                    get_passwords().add(*new_password_entry)  # One journal record, not a full rewrite
                     password_input = ""
                     current_screen = MAIN_MENU
                 else:
@@ -474,8 +540,7 @@ def handle_add_password_input():
             if confirm_character():
                 if len(password_input) == MAX_PASSWORD_LENGTH:
                     new_password_entry = [password_input] + [get_current_character() for _ in range(2)]
-                    passwords_data.append(new_password_entry)
-                    save_passwords(passwords_data)
+                    get_passwords().add(*new_password_entry)  # One journal record, not a full rewrite
                     password_input = ""
                     current_screen = MAIN_MENU
                 else:
@@ -525,14 +590,22 @@ def go_to_main_menu():
     global current_screen
     current_screen = MAIN_MENU
 
+@profiled("lock_device")
 def lock_device():
-    global current_screen, user_input_index, reset_button_press_count
-    encrypt_file()
+    global current_screen, user_input_index, reset_button_press_count, key, unlock_pattern
+    # Every change is already on flash as a journal record, so locking is
+    # only a RAM wipe plus the occasional compaction
+    if isinstance(passwords_data, PasswordEntries) and passwords_data.needs_compaction():
+        passwords_data.compact()
+    close_passwords()
+    key = None
+    unlock_pattern = None
     current_screen = LOCK_SCREEN
     reset_user_input()
     reset_button_press_count = 0
     
 ######################RTC#########################
+@profiled("draw_rtc_menu")
 def draw_rtc_menu():
     oled.fill(0)
     oled.text("RTC Menu", 10, 10, 1)
@@ -568,6 +641,7 @@ def handle_rtc_menu_input():
         current_screen = MAIN_MENU
         time.sleep(0.2)  # Debounce delay
         
+@profiled("draw_rtc_set_time")
 def draw_rtc_set_time(datetime_values, cursor_position):
     oled.fill(0)
     oled.text("Set RTC Time", 10, 10, 1)
@@ -661,6 +735,7 @@ def handle_rtc_set_time_input():
 
         
         
+@profiled("draw_rtc_check_time")
 def draw_rtc_check_time():
     oled.fill(0)
     oled.text("Current RTC Time", 10, 10, 1)
@@ -676,6 +751,7 @@ def handle_rtc_check_time_input():
     time.sleep(2)  # Pause for 2 seconds to display the time
     current_screen = RTC_MENU
 
+@profiled("draw_rtc_check_status")
 def draw_rtc_check_status():
     oled.fill(0)
     oled.text("RTC Status", 10, 10, 1)
@@ -694,8 +770,16 @@ def handle_rtc_check_status_input():
     
 ################Encryption###############################
 import os
-from encryption import derive_key, encrypt_password, decrypt_password
-
+import binascii
+from encryption import KDF_LEGACY, KDF_PBKDF2_SHA256, KDF_PBKDF2_SHA512, LEGACY_ITERATIONS, Sealer, check_wrapped_key, compare_digest, new_data_key, wrap_key, derive_key, start_key_derivation, new_kdf_params, encrypt_data, decrypt_data, decrypt_password
+from vault import VAULT_FILE, PasswordEntries, commit_vault, read_kdf_params, read_wrapped_key, recover_vault, seal_records
+from importer import import_csv
+from backup import BACKUP_FILE, export_backup, read_backup_header, restore_backup
+from keycache import clear_key, load_key, store_key
+from lockout import begin_attempt, end_attempt, next_attempt_time
+
+# Salt of vaults written before the KDF parameters moved into the vault
+# header, new vaults never read it
 SALT_FILE = "salt.bin"
 
 def save_salt(salt):
@@ -710,106 +794,590 @@ def load_salt():
         if len(salt) != 16:
             raise ValueError("Invalid salt length")
         return salt
-    except (FileNotFoundError, ValueError):
+    except (OSError, ValueError):
         new_salt = os.urandom(16)
         save_salt(new_salt)
         return new_salt
 
-salt = load_salt()
-iterations = 10  # You can now use a much higher iteration count
-unlock_pattern = ["up", "down", "up", "down", "up"]
+# Pattern entered to unlock, kept like the key until the device locks
+# again because re-deriving keys (KDF calibration, backups, the key cache)
+# needs it
+unlock_pattern = None
 key = None  # Initialize key as None
 
+# How long deriving the key of a new vault should take on this board,
+# the PBKDF2 iteration count is calibrated to it
+UNLOCK_TIME_BUDGET_MS = 2000
 
+# KDF for new vault keys and Calibrate KDF: KDF_PBKDF2_SHA256 or
+# KDF_PBKDF2_SHA512. Vaults keep the one they were made with until the
+# next calibration.
+VAULT_KDF = KDF_PBKDF2_SHA256
+
+# Fast unlock: keep the derived key on flash for keycache.KEY_CACHE_TTL
+# seconds, wrapped under a device secret and the pattern, so unlocking
+# again soon after skips the KDF. Off by default, the wrapped key is only
+# as strong as the pattern against someone who can read the flash.
+FAST_UNLOCK = False
+
+def kdf_name(kdf):
+    return "SHA-512" if kdf == KDF_PBKDF2_SHA512 else "SHA-256"
+
+def rtc_seconds():
+    return time.mktime(rtc.datetime)
+
+def get_kdf_params():
+    # (kdf, iterations, salt) from the vault header, or the legacy ones
+    params = read_kdf_params()
+    if params is None:
+        return KDF_LEGACY, LEGACY_ITERATIONS, load_salt()
+    return params
+
+@profiled("get_key")
 def get_key():
     global key
     if key is None:
-        key = derive_key(unlock_pattern, salt, iterations)
+        kdf, iterations, salt = get_kdf_params()
+        key = derive_key(unlock_pattern, salt, iterations, kdf)
     return key
 
+# Wrap the vault's data key under a key derived with a fresh salt and an
+# iteration count calibrated to UNLOCK_TIME_BUDGET_MS
+def recalibrate_kdf(entries):
+    global key
+    draw_encryption_status("Calibrating...")
+    params = new_kdf_params(UNLOCK_TIME_BUDGET_MS, VAULT_KDF)
+    kdf, iterations, salt = params
+    draw_encryption_status("Rewrapping key...", f"{iterations} iterations")
+    new_key = derive_key(unlock_pattern, salt, iterations, kdf)
+    entries.rekey(new_key, params)
+    key = new_key
+    clear_key()  # Wrapped for the old salt
+    print(f"Vault key now uses {iterations} PBKDF2-HMAC-{kdf_name(kdf)} iterations.")
+
+# A restored vault still on the legacy parameters moves to calibrated ones
+def upgrade_kdf():
+    entries = get_passwords()
+    if isinstance(entries, PasswordEntries) and entries.kdf_params is None:
+        try:
+            recalibrate_kdf(entries)
+        except (OSError, ValueError) as e:
+            print("Error upgrading key derivation:", e)
+
+# PBKDF2 iterations run per pass of the main loop while unlocking,
+# between redrawing the progress bar and polling RESET
+KDF_STEP_ITERATIONS = 10
+key_derivation = None
+unlock_started = 0
+
+# RTC time in seconds before which the lock screen takes no pattern. Every
+# attempt is counted on flash before the KDF runs and the delay grows with
+# each failure in a row, see lockout.py.
+unlock_not_before = 0
+
+def update_unlock_delay():
+    global unlock_not_before
+    try:
+        unlock_not_before = next_attempt_time(rtc_seconds())
+    except OSError as e:
+        print("Error updating unlock attempts:", e)
+
+def start_unlock(entered):
+    global current_screen, key_derivation, key, unlock_started, unlock_pattern
+    unlock_started = time.monotonic_ns()
+    if enrolling:
+        start_enrollment(entered)
+        return
+    try:
+        failures = begin_attempt(rtc_seconds())
+    except OSError as e:
+        # An attempt that cannot be counted is not made, or retries would
+        # go unlimited whenever the flash is read-only
+        print("Error recording unlock attempt:", e)
+        draw_encryption_status("Cannot unlock", "Flash read-only")
+        time.sleep(2)
+        return
+    print(f"Unlock attempt, {failures - 1} failed before")
+    unlock_pattern = list(entered)
+    kdf, iterations, salt = get_kdf_params()
+    if FAST_UNLOCK:
+        try:
+            key = load_key(unlock_pattern, salt, rtc_seconds())
+        except (OSError, ValueError) as e:
+            print("Error reading cached key:", e)
+        if key is not None and not pattern_key_matches(key):
+            # Stale, e.g. the vault was restored or rekeyed since
+            print("Cached key does not match the vault")
+            clear_key()
+            key = None
+        if key is not None:
+            if finish_unlock():
+                record_span("unlock", unlock_started)
+                print("Unlocked with cached key")
+                return
+            print("Cached key did not open the vault")
+            clear_key()
+            key = None
+    key_derivation = start_key_derivation(unlock_pattern, salt, iterations, kdf)
+    current_screen = UNLOCKING
+
+# A device without a vault takes its new pattern twice, then derives the
+# key of the new vault with freshly calibrated parameters. Nothing can be
+# guessed yet, so these are not counted as unlock attempts.
+def start_enrollment(entered):
+    global current_screen, enroll_pattern, key_derivation, new_vault_params, unlock_pattern
+    if enroll_pattern is None:
+        if len(entered) < PATTERN_MIN_LENGTH:
+            draw_encryption_status("Pattern too short", f"Min {PATTERN_MIN_LENGTH} presses")
+            time.sleep(1)
+            return
+        enroll_pattern = list(entered)  # The lock screen asks for it again
+        return
+    if list(entered) != enroll_pattern:
+        enroll_pattern = None
+        print("Patterns differ")
+        draw_encryption_status("Patterns differ", "Start again")
+        time.sleep(1)
+        return
+    enroll_pattern = None
+    unlock_pattern = list(entered)
+    draw_encryption_status("Calibrating...")
+    new_vault_params = new_kdf_params(UNLOCK_TIME_BUDGET_MS, VAULT_KDF)
+    kdf, iterations, salt = new_vault_params
+    key_derivation = start_key_derivation(unlock_pattern, salt, iterations, kdf)
+    current_screen = UNLOCKING
+
+@profiled("draw_unlocking")
+def draw_unlocking(progress):
+    oled.fill(0)
+    center_text("Unlocking...", 16)
+    oled.rect(4, 32, 120, 10, 1)
+    oled.fill_rect(6, 34, int(116 * progress), 6, 1)
+    center_text("RESET: cancel", 50)
+    oled.show()
 
-# Add this constant near the top of your file
+def handle_unlocking():
+    global current_screen, key_derivation, key, new_vault_params, unlock_pattern
+    if BUTTON_PINS["RESET"].value == 0:
+        print("Unlock cancelled")
+        key_derivation = None
+        new_vault_params = None
+        key = None
+        unlock_pattern = None
+        update_unlock_delay()  # A cancelled attempt still counts
+        current_screen = LOCK_SCREEN
+        time.sleep(0.2)  # Debounce delay
+        return
+
+    progress = key_derivation.step(KDF_STEP_ITERATIONS)
+    draw_unlocking(progress)
+    if key_derivation.done:
+        key = key_derivation.key()[:16]  # AES-128 key size
+        key_derivation = None
+        record_span("derive_key", unlock_started)
+        if new_vault_params is not None:
+            if isinstance(passwords_data, PasswordEntries):
+                if not change_pattern():
+                    unlock_failed("Cannot change pattern")
+                    return
+            elif not create_vault():
+                unlock_failed("Cannot create vault")
+                return
+        elif not pattern_key_matches(key):
+            reject_pattern()
+            return
+        if not finish_unlock():
+            unlock_failed("Cannot open vault")
+            return
+        record_span("unlock", unlock_started)
+        if FAST_UNLOCK and not enrolling:
+            store_key(key, unlock_pattern, get_kdf_params()[2], rtc_seconds())
+
+# Check a key derived from an entered pattern before anything is opened
+# or converted with it, so a wrong pattern costs one KDF run: against the
+# tag of the data key wrapped in the vault header, or for a legacy CSV
+# vault by decrypting its first password.
+def pattern_key_matches(candidate):
+    wrapped = read_wrapped_key()
+    if wrapped is not None:
+        return check_wrapped_key(candidate, wrapped)
+    return legacy_key_matches(candidate)
+
+def reject_pattern():
+    global current_screen, key, unlock_pattern
+    print("Incorrect pattern")
+    key = None
+    unlock_pattern = None
+    oled.fill(0)
+    center_text("Wrong pattern", 28)
+    oled.show()
+    time.sleep(1)
+    update_unlock_delay()
+    current_screen = LOCK_SCREEN
+
+# Back to the lock screen after a key that matched did not get the vault
+# open. The attempt stays counted.
+def unlock_failed(message):
+    global current_screen, enrolling, key, unlock_pattern
+    print(message)
+    close_passwords()
+    key = None
+    unlock_pattern = None
+    enrolling = vault_missing()  # A failed pattern change leaves the vault as it was
+    draw_encryption_status(message)
+    time.sleep(2)
+    update_unlock_delay()
+    current_screen = LOCK_SCREEN
+
+# Open the vault and go to the main menu. Returns False, with the device
+# still locked, if the vault did not load. A vault still on the legacy
+# parameters is under the pattern every legacy device shipped with, so
+# the lock screen takes a new one first.
+@profiled("finish_unlock")
+def finish_unlock():
+    global current_screen, enrolling
+    if not decrypt_file():  # Open the vault in RAM, nothing is written to flash
+        return False
+    end_attempt()
+    if passwords_data.kdf_params is None:
+        print("Legacy pattern, asking for a new one")
+        enrolling = True
+        current_screen = LOCK_SCREEN
+        return True
+    encrypt_file()  # Import a passwords.csv dropped on the drive, if any
+    current_screen = MAIN_MENU
+    return True
+
+
+# Legacy CSV vault, converted to VAULT_FILE on the first unlock
 ENCRYPTED_PASSWORDS_FILE = "encrypted_passwords.csv"
 
-def create_empty_encrypted_file():
+# Pattern every legacy CSV vault was encrypted under, it was hard-coded
+# before each vault had a pattern of its own
+LEGACY_PATTERN = ("up", "down", "up", "down", "up")
+
+# Pattern entered first on a device without a vault or with a converted
+# legacy one, and the (kdf, iterations, salt) of the key being derived
+# for it
+enroll_pattern = None
+new_vault_params = None
+
+def discard_empty_legacy_vault():
+    # Older firmware created an empty encrypted_passwords.csv on first
+    # boot. It holds nothing to convert, so it does not count as a vault.
     try:
-        # Try to open the file in read mode to check if it exists
-        with open(ENCRYPTED_PASSWORDS_FILE, "r"):
-            pass
+        with open(ENCRYPTED_PASSWORDS_FILE, "r") as file:
+            for line in file:
+                if line.strip():
+                    return
     except OSError:
-        # If the file doesn't exist, create an empty file
-        with open(ENCRYPTED_PASSWORDS_FILE, "w") as file:
+        return
+    os.remove(ENCRYPTED_PASSWORDS_FILE)
+    print(f"Removed empty {ENCRYPTED_PASSWORDS_FILE}.")
+
+def vault_missing():
+    # True if there is no vault generation and no legacy CSV vault, so the
+    # next pattern entered creates a new vault
+    for path in (VAULT_FILE, VAULT_FILE + ".tmp", VAULT_FILE + ".old", ENCRYPTED_PASSWORDS_FILE):
+        try:
+            os.stat(path)
+            return False
+        except OSError:
             pass
-        print("Created empty encrypted passwords file.")
+    return True
 
-# Modify the encrypt_file function
-def encrypt_file():
-    passwords_data = load_passwords()
-    if not passwords_data:
-        print("No passwords to encrypt.")
-        return
+def create_vault():
+    # Empty vault under a new data key wrapped with the key just derived
+    global enrolling, new_vault_params
+    kdf_params = new_vault_params
+    new_vault_params = None
+    data_key = new_data_key()
+    try:
+        commit_vault([], data_key, wrap_key(key, data_key), kdf_params=kdf_params)
+    except (OSError, ValueError) as e:
+        print("Error creating vault:", e)
+        return False
+    enrolling = False
+    print("Created empty vault file.")
+    return True
+
+def change_pattern():
+    # Wrap the data key of the open vault under the key just derived
+    global enrolling, new_vault_params
+    kdf_params = new_vault_params
+    new_vault_params = None
+    try:
+        passwords_data.rekey(key, kdf_params)
+    except (OSError, ValueError) as e:
+        print("Error changing pattern:", e)
+        return False
+    enrolling = False
+    clear_key()  # Cached for the old pattern
+    print("Changed vault pattern.")
+    return True
 
-    encrypted_passwords = []
-    for entry in passwords_data:
+def legacy_rows():
+    # Fields of every non-blank line of the legacy CSV vault
+    with open(ENCRYPTED_PASSWORDS_FILE, "r") as file:
+        for line in file:
+            line = line.strip()
+            if line:
+                yield line.split(',')
+
+def decrypt_legacy_password(candidate, encrypted):
+    # Raises ValueError if the password does not decrypt to UTF-8 text
+    password = decrypt_data(candidate, binascii.unhexlify(encrypted))
+    password.decode()
+    return password
+
+def read_legacy_passwords(candidate):
+    # Yield (site, username, password bytes) for each row of the legacy
+    # CSV vault, or None for a row that holds no entry. Only rows of three
+    # fields were encrypted. Older firmware wrote a row whose site or
+    # username has a comma as it was, so its last field is the password
+    # in plain text and the one before it the username.
+    for entry in legacy_rows():
         if len(entry) == 3:
-            encrypted_password = encrypt_password(get_key(), entry[2])
-            encrypted_passwords.append([entry[0], entry[1], encrypted_password])
+            yield entry[0], entry[1], decrypt_legacy_password(candidate, entry[2])
+        elif len(entry) > 3:
+            yield ",".join(entry[:-2]), entry[-2], entry[-1].encode()
         else:
-            encrypted_passwords.append(entry)
-    save_encrypted_passwords(encrypted_passwords)
-    print("File encrypted successfully!")
+            yield None
+
+def legacy_key_matches(candidate):
+    # CBC padding alone lets about one wrong key in 256 through, the
+    # first password also has to be valid UTF-8. Without an encrypted
+    # password to check against, only the key of LEGACY_PATTERN matches.
+    try:
+        for entry in legacy_rows():
+            if len(entry) == 3:
+                decrypt_legacy_password(candidate, entry[2])
+                return True
+    except (OSError, ValueError):
+        return False
+    kdf, iterations, salt = get_kdf_params()
+    return compare_digest(candidate, derive_key(LEGACY_PATTERN, salt, iterations, kdf))
+
+def convert_legacy_vault():
+    # Passwords are sealed in the vault's record format under a new data
+    # key, the names go into the vault's names blob. The CSV is only
+    # removed once the new vault opens with the same key and every record
+    # verifies, and kept if any row held no entry.
+    try:
+        rows = list(read_legacy_passwords(get_key()))
+    except OSError:
+        return
+    except ValueError as e:
+        print(f"Error converting {ENCRYPTED_PASSWORDS_FILE}:", e)
+        return
+
+    if recover_vault() is not None:
+        print(f"{VAULT_FILE} already exists, not converting {ENCRYPTED_PASSWORDS_FILE}.")
+        return
+    skipped = rows.count(None)
+    rows = [row for row in rows if row is not None]
+    data_key = new_data_key()
+    commit_vault(seal_records(Sealer(data_key), rows), data_key, wrap_key(get_key(), data_key))
+    entries = PasswordEntries(get_key())
+    try:
+        if len(entries) != len(rows) or entries.verify():
+            raise ValueError("Converted vault does not verify")
+    except Exception:
+        entries.wipe()
+        os.remove(VAULT_FILE)  # The CSV stays the vault
+        raise
+    entries.wipe()
+    print(f"Converted {len(rows)} passwords to {VAULT_FILE}.")
+    if skipped:
+        print(f"Kept {ENCRYPTED_PASSWORDS_FILE}, {skipped} rows could not be converted.")
+        draw_encryption_status(f"{skipped} rows skipped", "CSV kept")
+        time.sleep(2)
+        return
+    os.remove(ENCRYPTED_PASSWORDS_FILE)
+
+def draw_import_progress(count):
+    oled.fill(0)
+    center_text("Importing...", 20)
+    center_text(f"{count} passwords", 36)
+    oled.show()
+
+# Import a plaintext passwords.csv (or a CSV export from KeePass and the
+# like) into the vault and delete it. The file is streamed in chunks, so
+# large exports fit in RAM. Entries whose site and username are already
+# in the vault are skipped.
+@profiled("encrypt_file")
+def encrypt_file():
+    try:
+        os.stat(PASSWORDS_FILE)
+    except OSError:
+        return
+
+    entries = get_passwords()
+    if not isinstance(entries, PasswordEntries):
+        return
+    try:
+        imported = import_csv(entries, PASSWORDS_FILE, draw_import_progress)
+    except (OSError, ValueError) as e:
+        print("Error importing passwords:", e)
+        return
+    os.remove(PASSWORDS_FILE)
+    print(f"Imported {imported} passwords.")
 
-# Modify the decrypt_file function
+# Open the vault for this unlocked session, passwords are only decrypted
+# in RAM when an entry is shown or typed
+@profiled("decrypt_file")
 def decrypt_file():
-    encrypted_passwords = load_encrypted_passwords()
-    decrypted_passwords = []
-    for entry in encrypted_passwords:
-        if len(entry) == 3:
-            decrypted_password = decrypt_password(get_key(), entry[2])
-            if decrypted_password:
-                decrypted_passwords.append([entry[0], entry[1], decrypted_password])
-            else:
-                print(f"Failed to decrypt password for {entry[0]}")
-        else:
-            decrypted_passwords.append(entry)
-    save_passwords(decrypted_passwords)
-    print("File decrypted successfully!")
+    try:
+        convert_legacy_vault()
+    except (OSError, ValueError) as e:
+        print(f"Error converting {ENCRYPTED_PASSWORDS_FILE}:", e)
+        return False
+    if not isinstance(load_and_decrypt_passwords(), PasswordEntries):
+        return False
+    print("Vault unlocked.")
+    return True
 
 
-def save_encrypted_passwords(passwords_data):
-    with open(ENCRYPTED_PASSWORDS_FILE, "w") as file:
-        for entry in passwords_data:
-            file.write(','.join(entry) + '\n')
+# Open the vault without decrypting anything, passwords are decrypted
+# when an entry is shown or typed
 
-def load_encrypted_passwords():
+def load_and_decrypt_passwords():
+    global passwords_data
+    close_passwords()
     try:
-        with open(ENCRYPTED_PASSWORDS_FILE, "r") as file:
-            return [line.strip().split(',') for line in file]
+        passwords_data = PasswordEntries(get_key())
     except Exception as e:
         print("Error loading encrypted passwords:", e)
-        return []
+    return passwords_data
 
-# Modify the load_and_decrypt_passwords function
+def get_passwords():
+    if not isinstance(passwords_data, PasswordEntries):
+        load_and_decrypt_passwords()
+    return passwords_data
 
-def load_and_decrypt_passwords():
+def close_passwords():
     global passwords_data
-    encrypted_passwords = load_encrypted_passwords()
-    if not encrypted_passwords:
-        return []
+    if isinstance(passwords_data, PasswordEntries):
+        passwords_data.wipe()
+    passwords_data = []
 
-    decrypted_passwords = []
-    for entry in encrypted_passwords:
-        if len(entry) == 3:
-            decrypted_password = decrypt_password(get_key(), entry[2])
-            if decrypted_password:
-                decrypted_passwords.append([entry[0], entry[1], decrypted_password])
-            else:
-                print(f"Failed to decrypt password for {entry[0]}")
+######################Backup######################
+ENCRYPTION_MENU_OPTIONS = ["Export Backup", "Restore Backup", "Calibrate KDF", "Verify Vault"]
+
+@profiled("draw_encryption_menu")
+def draw_encryption_menu():
+    oled.fill(0)
+    oled.text("Encryption", 10, 10, 1)
+    for i, option in enumerate(ENCRYPTION_MENU_OPTIONS):
+        if i == selected_encryption_item:
+            oled.text("> " + option, 0, 24 + i * 10, 1)
         else:
-            decrypted_passwords.append(entry)
-    
-    passwords_data = decrypted_passwords
-    return decrypted_passwords
+            oled.text("  " + option, 0, 24 + i * 10, 1)
+    oled.show()
+
+def draw_encryption_status(message, detail=""):
+    oled.fill(0)
+    center_text(message, 20)
+    center_text(detail, 36)
+    oled.show()
+
+def handle_encryption_menu_input():
+    global current_screen, selected_encryption_item
+
+    if not BUTTON_PINS["UP"].value:
+        selected_encryption_item = (selected_encryption_item - 1) % len(ENCRYPTION_MENU_OPTIONS)
+        time.sleep(0.2)  # Debounce delay
+    elif not BUTTON_PINS["DOWN"].value:
+        selected_encryption_item = (selected_encryption_item + 1) % len(ENCRYPTION_MENU_OPTIONS)
+        time.sleep(0.2)  # Debounce delay
+    elif not BUTTON_PINS["CLICK"].value:
+        if selected_encryption_item == 0:
+            export_vault_backup()
+        elif selected_encryption_item == 1:
+            restore_vault_backup()
+        elif selected_encryption_item == 2:
+            calibrate_vault_kdf()
+        else:
+            verify_vault_entries()
+        time.sleep(2)  # Leave the result on screen
+
+    if BUTTON_PINS["SET"].value == 0:
+        current_screen = MAIN_MENU
+        time.sleep(0.2)  # Debounce delay
+
+# Write the vault and its KDF parameters to BACKUP_FILE on the drive
+def export_vault_backup():
+    entries = get_passwords()
+    if not isinstance(entries, PasswordEntries):
+        draw_encryption_status("Vault not open")
+        return
+    draw_encryption_status("Exporting...")
+    try:
+        count = export_backup(entries, get_key(), get_kdf_params())
+    except (OSError, ValueError) as e:
+        print("Error exporting backup:", e)
+        draw_encryption_status("Export failed")
+        return
+    print(f"Exported {count} passwords to {BACKUP_FILE}.")
+    draw_encryption_status("Backup saved", f"{count} passwords")
+
+# Replace the vault with BACKUP_FILE from the drive. The backup is
+# authenticated with the key derived from its own KDF parameters before
+# anything is written.
+def restore_vault_backup():
+    global key
+    draw_encryption_status("Verifying...")
+    try:
+        kdf, backup_iterations, backup_salt = read_backup_header()
+        backup_key = derive_key(unlock_pattern, backup_salt, backup_iterations, kdf)
+        close_passwords()
+        restore_backup(backup_key)
+        clear_key()
+    except (OSError, ValueError) as e:
+        print("Error restoring backup:", e)
+        draw_encryption_status("Restore failed")
+        load_and_decrypt_passwords()
+        return
+    if read_kdf_params() is None:
+        save_salt(backup_salt)  # Legacy vaults take their salt from salt.bin
+    key = backup_key
+    entries = load_and_decrypt_passwords()
+    upgrade_kdf()
+    print(f"Restored {len(entries)} passwords from {BACKUP_FILE}.")
+    draw_encryption_status("Restored", f"{len(entries)} passwords")
+
+def calibrate_vault_kdf():
+    entries = get_passwords()
+    if not isinstance(entries, PasswordEntries):
+        draw_encryption_status("Vault not open")
+        return
+    try:
+        recalibrate_kdf(entries)
+    except (OSError, ValueError) as e:
+        print("Error calibrating key derivation:", e)
+        draw_encryption_status("Calibration failed")
+        return
+    kdf, iterations, _ = entries.kdf_params
+    draw_encryption_status(f"Calibrated {kdf_name(kdf)}", f"{iterations} iterations")
+
+# Check the tag of every record without decrypting any password
+def verify_vault_entries():
+    entries = get_passwords()
+    if not isinstance(entries, PasswordEntries):
+        draw_encryption_status("Vault not open")
+        return
+    draw_encryption_status("Verifying...")
+    try:
+        damaged = entries.verify()
+    except (OSError, ValueError) as e:
+        print("Error verifying vault:", e)
+        draw_encryption_status("Verify failed")
+        return
+    if damaged:
+        print("Damaged entries:", ", ".join(entries.name(i)[0] for i in damaged))
+        draw_encryption_status("Vault damaged", f"{len(damaged)} entries")
+    else:
+        draw_encryption_status("Vault OK", f"{len(entries)} passwords")
 
 def draw_test_encryption(stage, data=None, error_message=None):
     oled.fill(0)
@@ -860,17 +1428,13 @@ def handle_test_encryption():
                 return
         
         elif stage == "encrypting":
-            # Load sample data
+            # Round-trip sample data in RAM, the vault is left untouched
             sample_data = [
                 ["Website1", "Username1", "Password1"],
                 ["Website2", "Username2", "!@#$54Password"],
                 ["Website3", "Username3", "Password3"]
             ]
-            save_passwords(sample_data)
-            
-            # Encrypt the file
-            encrypt_file()
-            encrypted_data = load_encrypted_passwords()
+            encrypted_data = [[entry[0], entry[1], encrypt_data(get_key(), entry[2].encode())] for entry in sample_data]
             stage = "encrypted"
             draw_test_encryption(stage, encrypted_data)
         
@@ -880,9 +1444,7 @@ def handle_test_encryption():
                 time.sleep(0.2)
         
         elif stage == "decrypting":
-            # Decrypt the file
-            decrypt_file()
-            decrypted_data = load_passwords()
+            decrypted_data = [[entry[0], entry[1], decrypt_password(get_key(), entry[2])] for entry in encrypted_data]
             stage = "decrypted"
             draw_test_encryption(stage, decrypted_data)
         
@@ -893,9 +1455,54 @@ def handle_test_encryption():
         
         time.sleep(0.1)
 
+######################Diagnostics######################
+# Time spent per profiled span name since boot, the slowest first. The
+# screen itself is not profiled so it does not show up in its own list.
+DIAGNOSTICS_LINES = 5
+diagnostics_offset = 0
+
+def draw_diagnostics():
+    rows = span_summary()
+    oled.fill(0)
+    oled.text("Diagnostics  ms", 0, 0, 1)
+    if not rows:
+        center_text("No spans yet", 28)
+    for i, (name, calls, total_us, max_us) in enumerate(rows[diagnostics_offset:diagnostics_offset + DIAGNOSTICS_LINES]):
+        oled.text(f"{truncate_text(name, 13):13}{total_us // 1000:>8}", 0, 10 + i * 9, 1)
+    oled.text("CLK:Dump RST:Clear", 0, 56, 1)
+    oled.show()
+
+def handle_diagnostics_input():
+    global current_screen, diagnostics_offset
+
+    if not BUTTON_PINS["UP"].value:
+        diagnostics_offset = max(diagnostics_offset - 1, 0)
+        time.sleep(0.2)  # Debounce delay
+    elif not BUTTON_PINS["DOWN"].value:
+        diagnostics_offset = min(diagnostics_offset + 1, max(len(span_summary()) - 1, 0))
+        time.sleep(0.2)  # Debounce delay
+    elif not BUTTON_PINS["CLICK"].value:
+        dump_spans()  # Over the serial console
+        time.sleep(0.2)  # Debounce delay
+    elif BUTTON_PINS["RESET"].value == 0:
+        clear_spans()
+        diagnostics_offset = 0
+        time.sleep(0.2)  # Debounce delay
+
+    if BUTTON_PINS["SET"].value == 0:
+        current_screen = MAIN_MENU
+        time.sleep(0.2)  # Debounce delay
+
 
 # Main loop
-create_empty_encrypted_file()  # Create empty file on first boot
+# Pick the newest valid vault generation, finishing or rolling back a
+# commit that was interrupted by a reset or power loss
+recover_vault()
+discard_empty_legacy_vault()
+enrolling = vault_missing()  # The first pattern entered creates the vault
+if not FAST_UNLOCK:
+    clear_key()  # Left over from when fast unlock was enabled
+update_unlock_delay()  # Failed attempts survive a reboot
 
 draw_loading_screen()
 
@@ -941,5 +1548,13 @@ while True:
         handle_encryption_menu_input()
     elif current_screen == TEST_ENCRYPTION:
         handle_test_encryption()
+    elif current_screen == SEARCH_PASSWORDS:
+        draw_search_passwords()
+        handle_search_passwords_input()
+    elif current_screen == UNLOCKING:
+        handle_unlocking()
+    elif current_screen == DIAGNOSTICS:
+        draw_diagnostics()
+        handle_diagnostics_input()
 
     time.sleep(0.01)  # Adjust as needed
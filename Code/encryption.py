@@ -2,69 +2,222 @@ import adafruit_hashlib as hashlib
 import aesio
 import binascii
 import os
+import time
+
+# adafruit_hashlib engines behind HMAC and PBKDF2
+HASH_ENGINE = "sha256_fast"
+HASH_ENGINE_512 = "sha512_fast"
+
+# Key derivation functions a vault or backup can name. KDF_LEGACY means
+# PBKDF2-HMAC-SHA256 with salt.bin and LEGACY_ITERATIONS.
+KDF_LEGACY, KDF_PBKDF2_SHA256, KDF_PBKDF2_SHA512 = 0, 1, 2
+LEGACY_ITERATIONS = 10
+
+# Bounds for calibrate_iterations(), and the iterations it times
+MIN_ITERATIONS = 10
+MAX_ITERATIONS = 1000000
+CALIBRATION_ITERATIONS = 20
+
+# HMAC-SHA256 context. The padded key blocks are hashed once, copy()
+# starts a new message from the saved inner and outer midstates, so each
+# MAC costs two compressions less.
+class HmacSha256:
+    engine = HASH_ENGINE
+    block_size = 64
+
+    def __init__(self, key, inner=None, outer=None):
+        if inner is None:
+            block_size = self.block_size
+            if len(key) > block_size:
+                key = hashlib.new(self.engine, key).digest()
+            if len(key) < block_size:
+                key = bytes(key) + b'\x00' * (block_size - len(key))
+            inner = hashlib.new(self.engine, bytes(x ^ 0x36 for x in key))
+            outer = hashlib.new(self.engine, bytes(x ^ 0x5C for x in key))
+        self._inner = inner
+        self._outer = outer
+
+    def copy(self):
+        # The outer state is only ever copied, never updated, so it can be shared
+        return self.__class__(None, self._inner.copy(), self._outer)
+
+    def update(self, data):
+        self._inner.update(bytes(data))
+
+    def digest(self):
+        outer = self._outer.copy()
+        outer.update(self._inner.digest())
+        return outer.digest()
+
+# HMAC-SHA512 context, the same midstate reuse on the SHA-512 engine
+class HmacSha512(HmacSha256):
+    engine = HASH_ENGINE_512
+    block_size = 128
 
 # HMAC-SHA256 function
 def hmac_sha256(key, message):
-    block_size = 64
-    if len(key) > block_size:
-        key = hashlib.sha256(key).digest()
-    if len(key) < block_size:
-        key += b'\x00' * (block_size - len(key))
-    inner_key = bytes(x ^ 0x36 for x in key)
-    outer_key = bytes(x ^ 0x5C for x in key)
-    inner_message = inner_key + message
-    outer_message = outer_key + hashlib.sha256(inner_message).digest()
-    return hashlib.sha256(outer_message).digest()
-
-# PBKDF2-HMAC-SHA256 function
+    mac = HmacSha256(key)
+    mac.update(message)
+    return mac.digest()
+
+# HMAC-SHA512 function
+def hmac_sha512(key, message):
+    mac = HmacSha512(key)
+    mac.update(message)
+    return mac.digest()
+
+# Compare two digests in time that does not depend on where they differ.
+# Every byte is visited and folded into one value without a branch, and
+# indexing instead of zip() keeps the loop from allocating.
+def compare_digest(a, b):
+    if len(a) != len(b):
+        return False
+    result = 0
+    for i in range(len(a)):
+        result |= a[i] ^ b[i]
+    return result == 0
+
+# PBKDF2-HMAC-SHA256 that can be run a few iterations at a time, so the
+# UI stays responsive while a key is derived
+class Pbkdf2:
+    hash_size = 32
+    hmac = HmacSha256
+    # Bytes of the block index appended to the salt. PBKDF2 says four,
+    # this KDF has always used one and existing vault keys depend on it.
+    index_size = 1
+
+    def __init__(self, password, salt, iterations, dklen=32):
+        if not isinstance(password, (bytes, bytearray)):
+            password = bytes(password, 'utf-8')
+        if not isinstance(salt, (bytes, bytearray)):
+            salt = bytes(salt, 'utf-8')
+        if not isinstance(iterations, int) or iterations < 1:
+            raise ValueError("iterations must be a positive integer")
+        if dklen < 1:
+            raise ValueError("dklen must be a positive integer")
+        self._prf = self.hmac(password)
+        self._salt = salt
+        self.iterations = iterations
+        self._blocks = (dklen + self.hash_size - 1) // self.hash_size
+        self._dk = bytearray(dklen)
+        self._block = 1
+        self._round = 0
+        self._u = None
+        # Running XOR of every U for the current block, updated in place
+        self._out = bytearray(self.hash_size)
+
+    @property
+    def done(self):
+        return self._block > self._blocks
+
+    @property
+    def progress(self):
+        """Fraction of the work done, from 0.0 to 1.0."""
+        done = (self._block - 1) * self.iterations + self._round
+        return min(done / (self._blocks * self.iterations), 1.0)
+
+    def step(self, n):
+        """Run up to n more iterations and return progress."""
+        while n > 0 and not self.done:
+            mac = self._prf.copy()
+            if self._round == 0:
+                mac.update(self._salt + self._block.to_bytes(self.index_size, "big"))
+                self._u = mac.digest()
+                self._out[:] = self._u
+            else:
+                mac.update(self._u)
+                u = self._u = mac.digest()
+                out = self._out
+                for i in range(self.hash_size):
+                    out[i] ^= u[i]
+            self._round += 1
+            n -= 1
+            if self._round == self.iterations:
+                start = (self._block - 1) * self.hash_size
+                self._dk[start:start + self.hash_size] = self._out[:len(self._dk) - start]
+                self._block += 1
+                self._round = 0
+        return self.progress
+
+    def key(self):
+        if not self.done:
+            raise ValueError("Key derivation has not finished")
+        return bytes(self._dk)
+
+# PBKDF2-HMAC-SHA512, twice the output per iteration of the SHA-256 one.
+# No key depends on it yet, so it follows the standard.
+class Pbkdf2Sha512(Pbkdf2):
+    hash_size = 64
+    hmac = HmacSha512
+    index_size = 4
+
+# PBKDF2-HMAC function for "sha256" and "sha512"
 def pbkdf2_hmac(hash_name, password, salt, iterations, dklen=None):
     if not isinstance(hash_name, str):
         raise TypeError("hash_name must be a string")
-    if not isinstance(password, (bytes, bytearray)):
-        password = bytes(password, 'utf-8')
-    if not isinstance(salt, (bytes, bytearray)):
-        salt = bytes(salt, 'utf-8')
-    if not isinstance(iterations, int) or iterations < 1:
-        raise ValueError("iterations must be a positive integer")
+    if hash_name == "sha256":
+        derivation = Pbkdf2
+    elif hash_name == "sha512":
+        derivation = Pbkdf2Sha512
+    else:
+        raise ValueError(f"Unsupported hash: {hash_name}")
     if dklen is None:
-        dklen = 32
-    if dklen < 1:
-        raise ValueError("dklen must be a positive integer")
+        dklen = derivation.hash_size
+    kdf = derivation(password, salt, iterations, dklen)
+    while not kdf.done:
+        kdf.step(iterations)
+    return kdf.key()
 
-    hash_size = 32
-    blocks_needed = (dklen + hash_size - 1) // hash_size
-    dk = bytearray(dklen)
-
-    for block_index in range(1, blocks_needed + 1):
-        block = hmac_sha256(password, salt + bytes([block_index]))
-        u = block
-        out = u
-        for _ in range(1, iterations):
-            u = hmac_sha256(password, u)
-            out = bytes(x ^ y for x, y in zip(out, u))
-        start = (block_index - 1) * hash_size
-        end = start + hash_size
-        dk[start:end] = out[:dklen - start]
-
-    return bytes(dk)
-
-
-# Modify the derive_key function
-def derive_key(unlock_pattern, salt, iterations):  # Increased from 10 to 100000
-    pattern_bytes = bytearray()
+
+# Map an unlock pattern to the password bytes fed to PBKDF2
+def pattern_bytes(unlock_pattern):
+    password = bytearray()
     for direction in unlock_pattern:
         if direction == "up":
-            pattern_bytes.append(0)
+            password.append(0)
         elif direction == "down":
-            pattern_bytes.append(1)
+            password.append(1)
         elif direction == "left":
-            pattern_bytes.append(2)
+            password.append(2)
         elif direction == "right":
-            pattern_bytes.append(3)
+            password.append(3)
         elif direction == "click":
-            pattern_bytes.append(4)
-    key = pbkdf2_hmac('sha256', pattern_bytes, salt, iterations)
-    return key[:16]  # AES-128 key size
+            password.append(4)
+    return password
+
+# Start deriving the key for a pattern, call step() until done and take
+# the first 16 bytes of key() as the AES-128 key
+def start_key_derivation(unlock_pattern, salt, iterations, kdf=KDF_PBKDF2_SHA256):
+    return _derivation(kdf)(pattern_bytes(unlock_pattern), salt, iterations)
+
+# Pbkdf2 class behind a KDF id
+def _derivation(kdf):
+    if kdf in (KDF_LEGACY, KDF_PBKDF2_SHA256):
+        return Pbkdf2
+    if kdf == KDF_PBKDF2_SHA512:
+        return Pbkdf2Sha512
+    raise ValueError(f"Unsupported key derivation: {kdf}")
+
+# Derive the key in one go
+def derive_key(unlock_pattern, salt, iterations, kdf=KDF_PBKDF2_SHA256):
+    derivation = start_key_derivation(unlock_pattern, salt, iterations, kdf)
+    derivation.step(iterations)
+    return derivation.key()[:16]  # AES-128 key size
+
+# Largest iteration count whose derivation fits in budget_ms on this
+# board, measured by timing a short run of the real KDF
+def calibrate_iterations(budget_ms, sample=CALIBRATION_ITERATIONS, kdf=KDF_PBKDF2_SHA256):
+    derivation = _derivation(kdf)(os.urandom(8), os.urandom(16), sample + 1)
+    derivation.step(1)  # Keeps the HMAC key setup out of the timing
+    start = time.monotonic_ns()
+    derivation.step(sample)
+    elapsed = max(time.monotonic_ns() - start, 1)
+    iterations = budget_ms * 1000000 * sample // elapsed
+    return max(MIN_ITERATIONS, min(MAX_ITERATIONS, iterations))
+
+# Fresh KDF parameters for a new vault key: (kdf, iterations, salt)
+def new_kdf_params(budget_ms, kdf=KDF_PBKDF2_SHA256):
+    return kdf, calibrate_iterations(budget_ms, kdf=kdf), os.urandom(16)
 
 # Initialize AES cipher
 def initialize_cipher(key, iv):
@@ -75,46 +228,310 @@ def pad(data):
     padding_length = 16 - (len(data) % 16)
     return data + bytes([padding_length] * padding_length)
 
-# Unpad data
-def unpad(data):
-    padding_length = data[-1]
+# Length of the padding at the end of a decrypted block run, raises
+# ValueError if it is malformed
+def _padding_length(buffer, end):
+    padding_length = buffer[end - 1]
     if padding_length < 1 or padding_length > 16:
         raise ValueError(f"Invalid padding length: {padding_length}")
-    if data[-padding_length:] != bytes([padding_length] * padding_length):
-        raise ValueError("Invalid padding bytes")
-    return data[:-padding_length]
+    for i in range(end - padding_length, end - 1):
+        if buffer[i] != padding_length:
+            raise ValueError("Invalid padding bytes")
+    return padding_length
 
-# Encrypt password
-# Encrypt password
-# Modify the encrypt_password function
+# Unpad data
+def unpad(data):
+    return data[:len(data) - _padding_length(data, len(data))]
 
-# Encrypt password (modified to include IV)
-def encrypt_password(key, password):
+# Encrypt raw bytes, returns IV + ciphertext. The whole padded buffer goes
+# through aesio in one call straight into the output after the IV
+def encrypt_data(key, data):
     iv = os.urandom(16)  # Generate a unique IV for each encryption
-    cipher = initialize_cipher(key, iv)
-    password_bytes = pad(password.encode())
-    encrypted_password = bytearray()
-    for i in range(0, len(password_bytes), 16):
-        block = password_bytes[i:i+16]
-        encrypted_block = bytearray(16)
-        cipher.encrypt_into(block, encrypted_block)
-        encrypted_password.extend(encrypted_block)
-    return binascii.hexlify(iv + encrypted_password).decode()  # Include IV in the output
-
-# Decrypt password (modified to extract IV)
+    padded_data = pad(data)
+    encrypted_data = bytearray(16 + len(padded_data))
+    encrypted_data[:16] = iv
+    initialize_cipher(key, iv).encrypt_into(padded_data, memoryview(encrypted_data)[16:])
+    return encrypted_data
+
+# Decrypt IV + ciphertext back to raw bytes, raises ValueError on bad padding
+def decrypt_data(key, encrypted_data):
+    encrypted_data = memoryview(encrypted_data)
+    length = len(encrypted_data) - 16
+    if length <= 0 or length % 16:
+        raise ValueError(f"Invalid ciphertext length: {max(length, 0)}")
+    decrypted_data = bytearray(length)
+    initialize_cipher(key, encrypted_data[:16]).decrypt_into(encrypted_data[16:], decrypted_data)
+    return bytes(unpad(decrypted_data))
+
+# Sealed records: 16-byte nonce, AES-CTR ciphertext of the same length as
+# the plaintext, then the first SEAL_TAG_SIZE bytes of HMAC-SHA256 over
+# the associated data, nonce and ciphertext (encrypt-then-MAC). The
+# associated data is authenticated but not stored, it is prefixed with its
+# 2-byte length in the MAC so it can never run into the nonce.
+SEAL_TAG_SIZE = 16
+SEAL_OVERHEAD = 16 + SEAL_TAG_SIZE
+
+# Bytes a sealed stream is processed in. aesio starts a new CTR block on
+# every call, so this has to be a multiple of 16.
+STREAM_CHUNK_SIZE = 256
+
+# Fill view from file, returns the number of bytes read (short at EOF)
+def _read_full(file, view):
+    total = 0
+    while total < len(view):
+        read = file.readinto(view[total:])
+        if not read:
+            break
+        total += read
+    return total
+
+# Authenticated encryption of vault records. The CTR and MAC keys are
+# derived from the vault key once per session and one AES object is
+# rekeyed per record. open() checks the tag with a single constant-time
+# compare before any AES work, so tampered records cost one HMAC. Streams
+# use the same layout with the data read and written in chunks. Every
+# method takes the associated data the record was sealed with, batches a
+# list of it with one item per record or None.
+class Sealer:
+    def __init__(self, key):
+        self._key = hmac_sha256(key, b"G8KEEPER record key")[:16]
+        self._mac = HmacSha256(hmac_sha256(key, b"G8KEEPER record mac"))
+        self._cipher = None
+
+    def _crypt(self, nonce, source, target):
+        if self._cipher is None:
+            self._cipher = aesio.AES(self._key, aesio.MODE_CTR, nonce)
+        else:
+            self._cipher.rekey(self._key, nonce)
+        self._cipher.encrypt_into(source, target)
+
+    def _start_mac(self, associated):
+        mac = self._mac.copy()
+        mac.update(len(associated).to_bytes(2, "little"))
+        if len(associated):
+            mac.update(associated)
+        return mac
+
+    def _tag(self, data, associated=b""):
+        mac = self._start_mac(associated)
+        mac.update(data)
+        return mac.digest()[:SEAL_TAG_SIZE]
+
+    def verify(self, sealed, associated=b""):
+        # True if sealed is a well-formed record with a valid tag
+        sealed = memoryview(sealed)
+        if len(sealed) < SEAL_OVERHEAD:
+            return False
+        return compare_digest(self._tag(sealed[:-SEAL_TAG_SIZE], associated), sealed[-SEAL_TAG_SIZE:])
+
+    def seal(self, data, associated=b""):
+        return self.seal_batch([data], [associated])[0]
+
+    def open(self, sealed, associated=b""):
+        return bytes(self.open_batch([sealed], [associated])[0])
+
+    def seal_batch(self, items, associated=None):
+        # Returns memoryview slices of one output buffer, one record per item
+        output = bytearray(sum(len(data) for data in items) + SEAL_OVERHEAD * len(items))
+        view = memoryview(output)
+        nonces = memoryview(os.urandom(16 * len(items)))
+        results = []
+        offset = 0
+        for index, data in enumerate(items):
+            end = offset + 16 + len(data)
+            view[offset:offset + 16] = nonces[16 * index:16 * index + 16]
+            if len(data):
+                self._crypt(view[offset:offset + 16], data, view[offset + 16:end])
+            view[end:end + SEAL_TAG_SIZE] = self._tag(view[offset:end], associated[index] if associated else b"")
+            results.append(view[offset:end + SEAL_TAG_SIZE])
+            offset = end + SEAL_TAG_SIZE
+        return results
+
+    def open_batch(self, items, associated=None):
+        # Returns memoryview slices of one output buffer holding each
+        # plaintext. Every tag is checked before anything is decrypted,
+        # raises ValueError if one does not verify.
+        total = 0
+        for index, sealed in enumerate(items):
+            if not self.verify(sealed, associated[index] if associated else b""):
+                raise ValueError("Record authentication failed")
+            total += len(sealed) - SEAL_OVERHEAD
+        output = bytearray(total)
+        view = memoryview(output)
+        results = []
+        offset = 0
+        for sealed in items:
+            sealed = memoryview(sealed)
+            end = offset + len(sealed) - SEAL_OVERHEAD
+            if end > offset:
+                self._crypt(sealed[:16], sealed[16:-SEAL_TAG_SIZE], view[offset:end])
+            results.append(view[offset:end])
+            offset = end
+        return results
+
+    def writer(self, target, associated=b"", chunk_size=STREAM_CHUNK_SIZE):
+        # Start a sealed stream on target, returns a SealedWriter that
+        # takes the plaintext in pieces of any size
+        nonce = os.urandom(16)
+        mac = self._start_mac(associated)
+        mac.update(nonce)
+        target.write(nonce)
+        return SealedWriter(target, aesio.AES(self._key, aesio.MODE_CTR, nonce), mac, chunk_size)
+
+    def seal_stream(self, source, target, length, associated=b"", chunk_size=STREAM_CHUNK_SIZE):
+        # Seal length bytes read from source into target
+        writer = self.writer(target, associated, chunk_size)
+        plain = memoryview(bytearray(chunk_size))
+        while length:
+            read = _read_full(source, plain[:min(length, chunk_size)])
+            if read != min(length, chunk_size):
+                raise ValueError("Truncated stream")
+            writer.write(plain[:read])
+            length -= read
+        writer.close()
+
+    def open_stream(self, source, length, associated=b"", chunk_size=STREAM_CHUNK_SIZE):
+        # Check the tag of a stream of length plaintext bytes sealed at the
+        # current position of source in one pass, then return a
+        # SealedReader that decrypts it in a second pass. Raises
+        # ValueError before anything is decrypted if the tag is wrong.
+        nonce = source.read(16)
+        if len(nonce) != 16:
+            raise ValueError("Truncated stream")
+        start = source.tell()
+        mac = self._start_mac(associated)
+        mac.update(nonce)
+        buffer = bytearray(chunk_size)
+        view = memoryview(buffer)
+        remaining = length
+        while remaining:
+            read = source.readinto(view[:min(remaining, chunk_size)])
+            if not read:
+                raise ValueError("Truncated stream")
+            mac.update(view[:read])
+            remaining -= read
+        if not compare_digest(mac.digest()[:SEAL_TAG_SIZE], source.read(SEAL_TAG_SIZE)):
+            raise ValueError("Stream authentication failed")
+        source.seek(start)
+        return SealedReader(source, aesio.AES(self._key, aesio.MODE_CTR, nonce), length, buffer)
+
+# Writing end of a sealed stream, returned by Sealer.writer(). Whole
+# blocks are encrypted as they arrive through a buffer of fixed size, a
+# partial block waits for the next write() because aesio starts a new CTR
+# block on every call. close() encrypts the rest and writes the tag.
+class SealedWriter:
+    def __init__(self, file, cipher, mac, chunk_size):
+        self._file = file
+        self._cipher = cipher
+        self._mac = mac
+        self._encrypted = memoryview(bytearray(chunk_size))
+        self._pending = bytearray()
+
+    def _encrypt(self, data):
+        step = len(self._encrypted)
+        for start in range(0, len(data), step):
+            piece = data[start:start + step]
+            encrypted = self._encrypted[:len(piece)]
+            self._cipher.encrypt_into(piece, encrypted)
+            self._mac.update(encrypted)
+            self._file.write(encrypted)
+
+    def write(self, data):
+        data = memoryview(data)
+        if self._pending:
+            take = min(16 - len(self._pending), len(data))
+            self._pending.extend(data[:take])
+            data = data[take:]
+            if len(self._pending) < 16:
+                return
+            self._encrypt(self._pending)
+            self._pending = bytearray()
+        whole = len(data) - len(data) % 16
+        self._encrypt(data[:whole])
+        self._pending.extend(data[whole:])
+
+    def close(self):
+        self._encrypt(self._pending)
+        self._pending = bytearray()
+        self._file.write(self._mac.digest()[:SEAL_TAG_SIZE])
+
+# File-like view of a verified sealed stream, returned by
+# Sealer.open_stream(). read() and readinto() return plaintext, which is
+# decrypted a chunk at a time into a buffer of fixed size.
+class SealedReader:
+    def __init__(self, file, cipher, length, buffer):
+        self._file = file
+        self._cipher = cipher
+        self._remaining = length
+        self._encrypted = memoryview(buffer)
+        self._plain = memoryview(bytearray(len(buffer)))
+        self._start = 0
+        self._end = 0
+
+    def _fill(self):
+        view = self._encrypted[:min(self._remaining, len(self._encrypted))]
+        if _read_full(self._file, view) != len(view):
+            raise ValueError("Truncated stream")
+        self._cipher.decrypt_into(view, self._plain[:len(view)])
+        self._remaining -= len(view)
+        self._start = 0
+        self._end = len(view)
+
+    def readinto(self, buffer):
+        if self._start == self._end:
+            if not self._remaining:
+                return 0
+            self._fill()
+        count = min(len(buffer), self._end - self._start)
+        buffer[:count] = self._plain[self._start:self._start + count]
+        self._start += count
+        return count
+
+    def read(self, size):
+        data = bytearray(size)
+        count = _read_full(self, memoryview(data))
+        return bytes(data[:count])
+
+# Envelope encryption: vault contents are encrypted with a random data
+# key, only the copy of it sealed under the key derived from the unlock
+# pattern depends on the pattern
+DATA_KEY_SIZE = 16
+WRAPPED_KEY_SIZE = DATA_KEY_SIZE + SEAL_OVERHEAD
+
+def new_data_key():
+    return os.urandom(DATA_KEY_SIZE)
+
+# Seal data_key under key, returns WRAPPED_KEY_SIZE bytes
+def wrap_key(key, data_key):
+    return bytes(Sealer(key).seal(data_key))
+
+# Recover the data key sealed by wrap_key(), raises ValueError if key is
+# not the one it was wrapped under
+def unwrap_key(key, wrapped):
+    try:
+        data_key = Sealer(key).open(wrapped)
+    except ValueError:
+        raise ValueError("Wrong key or damaged wrapped key")
+    if len(data_key) != DATA_KEY_SIZE:
+        raise ValueError(f"Invalid data key length: {len(data_key)}")
+    return data_key
+
+# True if wrapped was made by wrap_key() under key. Only the tag is
+# checked, so a wrong key is rejected without decrypting anything.
+def check_wrapped_key(key, wrapped):
+    return len(wrapped) == WRAPPED_KEY_SIZE and Sealer(key).verify(wrapped)
+
+# Encrypt password (hex encoded IV + ciphertext)
+def encrypt_password(key, password):
+    return binascii.hexlify(encrypt_data(key, password.encode())).decode()
+
+# Decrypt password, accepts raw vault bytes or the legacy hex string
 def decrypt_password(key, encrypted_password):
     try:
-        encrypted_data = binascii.unhexlify(encrypted_password)
-        iv, ciphertext = encrypted_data[:16], encrypted_data[16:]
-        cipher = initialize_cipher(key, iv)
-        decrypted_password = bytearray()
-        for i in range(0, len(ciphertext), 16):
-            block = ciphertext[i:i+16]
-            decrypted_block = bytearray(16)
-            cipher.decrypt_into(block, decrypted_block)
-            decrypted_password.extend(decrypted_block)
-        return unpad(decrypted_password).decode()
-    except Exception as e:
+        if isinstance(encrypted_password, str):
+            encrypted_password = binascii.unhexlify(encrypted_password)
+        return decrypt_data(key, encrypted_password).decode()
+    except ValueError as e:
         print(f"Error during decryption: {e}")
         return None
 
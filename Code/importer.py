@@ -0,0 +1,160 @@
+from vault import MAX_NAME_LENGTH, seal_records
+
+# Bytes read from the export per call, the whole file is never in RAM
+IMPORT_CHUNK_SIZE = 512
+
+# Rows encrypted together before they are written to the vault
+IMPORT_BATCH_SIZE = 16
+
+QUOTE, COMMA, CR, LF = 0x22, 0x2C, 0x0D, 0x0A
+BOM = b"\xef\xbb\xbf"  # UTF-8 byte order mark, Excel starts its exports with one
+
+# Header names used by common exports (KeePass 1.x, KeePassXC, Bitwarden,
+# browsers) and by the service_name,username,password layout of the
+# README, matched case-insensitively in order of preference. Files without
+# a header are read as site,username,password rows, a first row that names
+# a known column but no password column is rejected as a header.
+SITE_COLUMNS = ("service_name", "service", "site", "title", "account", "name", "web site", "website", "url", "login_uri")
+USERNAME_COLUMNS = ("username", "user name", "user", "login name", "login_username", "login", "email")
+PASSWORD_COLUMNS = ("password", "login_password", "pass")
+
+
+def read_csv_rows(file, chunk_size=IMPORT_CHUNK_SIZE):
+    """
+    Yield the rows of a CSV file opened in binary mode as lists of str.
+    Quoted fields may contain commas, doubled quotes and line breaks, and
+    may span chunk boundaries.
+    """
+    buffer = bytearray(chunk_size)
+    row = []
+    field = bytearray()
+    quoted = False
+    after_quote = False
+    start = None
+    while True:
+        read = file.readinto(buffer)
+        if not read:
+            break
+        if start is None:
+            start = len(BOM) if buffer[:len(BOM)] == BOM else 0
+        else:
+            start = 0
+        for byte in memoryview(buffer)[start:read]:
+            if quoted:
+                if byte == QUOTE:
+                    quoted = False
+                    after_quote = True
+                else:
+                    field.append(byte)
+                continue
+            if after_quote and byte == QUOTE:
+                # Doubled quote inside a quoted field
+                field.append(QUOTE)
+                quoted = True
+                after_quote = False
+                continue
+            after_quote = False
+            if byte == QUOTE and not field:
+                quoted = True
+            elif byte == COMMA:
+                row.append(bytes(field).decode())
+                field = bytearray()
+            elif byte == LF:
+                row.append(bytes(field).decode())
+                field = bytearray()
+                if row != [""]:
+                    yield row
+                row = []
+            elif byte != CR:
+                field.append(byte)
+    if field or row:
+        row.append(bytes(field).decode())
+        yield row
+
+
+def _find_column(header, names):
+    for name in names:
+        if name in header:
+            return header.index(name)
+    return None
+
+
+def read_entries(file, chunk_size=IMPORT_CHUNK_SIZE):
+    """
+    Yield (site, username, password) tuples from a CSV or KeePass-style
+    export. Rows without a password are skipped.
+    """
+    rows = read_csv_rows(file, chunk_size)
+    first = None
+    for first in rows:
+        break
+    if first is None:
+        return
+
+    header = [name.strip().lower() for name in first]
+    password_column = _find_column(header, PASSWORD_COLUMNS)
+    if password_column is None:
+        if _find_column(header, SITE_COLUMNS) is not None or _find_column(header, USERNAME_COLUMNS) is not None:
+            raise ValueError("Header row has no password column")
+        site_column, username_column, password_column = 0, 1, 2
+        rows_with_first = [first]
+    else:
+        site_column = _find_column(header, SITE_COLUMNS)
+        username_column = _find_column(header, USERNAME_COLUMNS)
+        rows_with_first = []
+
+    for source in (rows_with_first, rows):
+        for row in source:
+            if len(row) <= password_column or not row[password_column]:
+                continue
+            site = row[site_column] if site_column is not None and site_column < len(row) else ""
+            username = row[username_column] if username_column is not None and username_column < len(row) else ""
+            yield site, username, row[password_column]
+
+
+def encrypted_records(file, sealer, exists=None, progress=None):
+    """
+    Yield (site, username, secret) records for VaultWriter, sealing the
+    passwords with the vault's encryption.Sealer sealer IMPORT_BATCH_SIZE
+    rows at a time. Rows for which exists(site, username) is true are
+    skipped. Repeats within the file are kept, exports can hold entries
+    that only differ in their password, and remembering every name read
+    would grow with the file. progress is called with the running count
+    after each batch.
+    """
+    batch = []
+    count = 0
+    for site, username, password in read_entries(file):
+        if exists is not None and exists(site, username):
+            continue
+        if len(site.encode()) > MAX_NAME_LENGTH or len(username.encode()) > MAX_NAME_LENGTH:
+            print(f"Skipping entry with a name too long: {site[:16]}")
+            continue
+        batch.append((site, username, password.encode()))
+        if len(batch) == IMPORT_BATCH_SIZE:
+            yield from seal_records(sealer, batch)
+            count += len(batch)
+            batch = []
+            if progress:
+                progress(count)
+    if batch:
+        yield from seal_records(sealer, batch)
+        count += len(batch)
+        if progress:
+            progress(count)
+
+
+def import_csv(entries, path, progress=None):
+    """
+    Stream the export at path into the vault behind the PasswordEntries
+    session entries with a single vault rewrite. Returns the number of
+    imported entries. Entries already in the vault are found through its
+    search index, so the vault's names are never decoded in bulk.
+    """
+    def exists(site, username):
+        return entries.find(site, username) is not None
+
+    before = len(entries)
+    with open(path, "rb") as file:
+        entries.compact(encrypted_records(file, entries.sealer, exists, progress))
+    return len(entries) - before
@@ -0,0 +1,85 @@
+import os
+import struct
+from encryption import compare_digest, decrypt_data, encrypt_data, hmac_sha256, pattern_bytes
+
+KEY_CACHE_FILE = "key.cache"
+DEVICE_SECRET_FILE = "device.secret"
+KEY_CACHE_MAGIC = b"G8KC"
+KEY_CACHE_VERSION = 1
+
+# Cache: magic, version, expiry time in RTC seconds and the KDF salt of
+# the vault the key belongs to, followed by the wrapped key (IV +
+# ciphertext) and a HMAC-SHA256 tag over everything before it
+KEY_CACHE_FORMAT = "<4sBI16s"
+KEY_CACHE_SIZE = struct.calcsize(KEY_CACHE_FORMAT)
+TAG_SIZE = 32
+
+# Seconds a cached key stays valid
+KEY_CACHE_TTL = 15 * 60
+
+
+def _device_secret():
+    # Chip id plus a random secret made on first use. Both live on the
+    # board, so they only tie the cache to this device: whoever can read
+    # the flash and guess the pattern can unwrap the key without the KDF.
+    try:
+        import microcontroller
+        uid = bytes(microcontroller.cpu.uid)
+    except (ImportError, AttributeError):
+        uid = b""
+    try:
+        with open(DEVICE_SECRET_FILE, "rb") as file:
+            secret = file.read()
+    except OSError:
+        secret = b""
+    if len(secret) != 32:
+        secret = os.urandom(32)
+        with open(DEVICE_SECRET_FILE, "wb") as file:
+            file.write(secret)
+    return uid + secret
+
+
+def _cache_keys(unlock_pattern, salt):
+    master = hmac_sha256(_device_secret(), bytes(pattern_bytes(unlock_pattern)) + salt)
+    return hmac_sha256(master, b"wrap")[:16], hmac_sha256(master, b"tag")
+
+
+def store_key(key, unlock_pattern, salt, now, ttl=KEY_CACHE_TTL, path=KEY_CACHE_FILE):
+    """
+    Cache key wrapped under the device secret and unlock_pattern until
+    now + ttl seconds.
+    """
+    wrap_key, tag_key = _cache_keys(unlock_pattern, salt)
+    data = struct.pack(KEY_CACHE_FORMAT, KEY_CACHE_MAGIC, KEY_CACHE_VERSION, now + ttl, salt) + encrypt_data(wrap_key, key)
+    with open(path, "wb") as file:
+        file.write(data)
+        file.write(hmac_sha256(tag_key, data))
+
+
+def load_key(unlock_pattern, salt, now, ttl=KEY_CACHE_TTL, path=KEY_CACHE_FILE):
+    """
+    Return the cached key for the vault with KDF salt and unlock_pattern,
+    or None. A cache that is expired, belongs to another vault or does not
+    verify is deleted, so it allows a single try.
+    """
+    try:
+        with open(path, "rb") as file:
+            data = file.read()
+    except OSError:
+        return None
+    if len(data) > KEY_CACHE_SIZE + TAG_SIZE:
+        magic, version, expires, cached_salt = struct.unpack_from(KEY_CACHE_FORMAT, data)
+        # A clock set backwards must not stretch the TTL
+        if magic == KEY_CACHE_MAGIC and version == KEY_CACHE_VERSION and cached_salt == salt and now < expires <= now + ttl:
+            wrap_key, tag_key = _cache_keys(unlock_pattern, salt)
+            if compare_digest(hmac_sha256(tag_key, data[:-TAG_SIZE]), data[-TAG_SIZE:]):
+                return decrypt_data(wrap_key, data[KEY_CACHE_SIZE:-TAG_SIZE])
+    clear_key(path)
+    return None
+
+
+def clear_key(path=KEY_CACHE_FILE):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
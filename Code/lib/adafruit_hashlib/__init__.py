@@ -30,19 +30,27 @@ except ImportError:
 
 
 try:
-    from hashlib import md5, sha1, sha224, sha256, sha512
-    from hashlib import sha3_384 as sha384
+    from hashlib import md5, sha1, sha224, sha256, sha384, sha512
+
+    # The native engines are faster than any pure Python one
+    sha224_fast, sha256_fast = sha224, sha256
+    sha384_fast, sha512_fast = sha384, sha512
 except ImportError:
     from adafruit_hashlib._sha256 import sha224, sha256
+    from adafruit_hashlib._sha256_fast import sha224 as sha224_fast
+    from adafruit_hashlib._sha256_fast import sha256 as sha256_fast
     from adafruit_hashlib._sha512 import sha384, sha512
+    from adafruit_hashlib._sha512_fast import sha384 as sha384_fast
+    from adafruit_hashlib._sha512_fast import sha512 as sha512_fast
     from adafruit_hashlib._sha1 import sha1
     from adafruit_hashlib._md5 import md5
 
 __version__ = "1.4.15"
 __repo__ = "https://github.com/adafruit/Adafruit_CircuitPython_hashlib.git"
 
-# FIPS secure hash algorithms supported by this library
-ALGOS_AVAIL = ["sha1", "md5", "sha224", "sha256", "sha384", "sha512"]
+# FIPS secure hash algorithms supported by this library. The _fast
+# variants compute the same digests with the word-oriented engine.
+ALGOS_AVAIL = ["sha1", "md5", "sha224", "sha256", "sha384", "sha512", "sha224_fast", "sha256_fast", "sha384_fast", "sha512_fast"]
 
 
 def new(algo, data: Optional[bytes] = b"") -> Union[md5, sha1, sha224, sha256, sha512]:
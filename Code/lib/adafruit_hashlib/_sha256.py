@@ -438,6 +438,8 @@ class sha256:
         """Return a copy (“clone”) of the hash object."""
         new = sha256()
         new._sha = self._sha.copy()
+        new._sha["digest"] = self._sha["digest"][:]
+        new._sha["data"] = self._sha["data"][:]
         return new
 
 
@@ -456,4 +458,6 @@ class sha224(sha256):
         """Return a copy (“clone”) of the hash object."""
         new = sha224()
         new._sha = self._sha.copy()
+        new._sha["digest"] = self._sha["digest"][:]
+        new._sha["data"] = self._sha["data"][:]
         return new
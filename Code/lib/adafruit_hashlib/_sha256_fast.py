@@ -0,0 +1,154 @@
+# SPDX-FileCopyrightText: 2017 Paul Sokolovsky
+# SPDX-FileCopyrightText: 2019 Brent Rubell for Adafruit Industries
+#
+# SPDX-License-Identifier: MIT
+
+"""
+`_sha256_fast.py`
+======================================================
+Word-oriented SHA-256 engine. State and message schedule live in
+preallocated ``array('L')`` buffers, rotations are written out inline and
+compressing a block allocates no lists, dicts or closures.
+* Author(s): Tom St Denis, Paul Sokolovsky, Brent Rubell
+"""
+# pylint: disable=invalid-name, too-many-locals, missing-docstring
+
+import struct
+from array import array
+
+try:
+    from typing import Optional, Union
+except ImportError:
+    # suppress because typing does not exist on circuitpython
+    pass
+
+SHA_BLOCKSIZE = 64
+SHA_DIGESTSIZE = 32
+
+# fmt: off
+_K = array("L", (
+    0x428A2F98, 0x71374491, 0xB5C0FBCF, 0xE9B5DBA5, 0x3956C25B, 0x59F111F1, 0x923F82A4, 0xAB1C5ED5,
+    0xD807AA98, 0x12835B01, 0x243185BE, 0x550C7DC3, 0x72BE5D74, 0x80DEB1FE, 0x9BDC06A7, 0xC19BF174,
+    0xE49B69C1, 0xEFBE4786, 0x0FC19DC6, 0x240CA1CC, 0x2DE92C6F, 0x4A7484AA, 0x5CB0A9DC, 0x76F988DA,
+    0x983E5152, 0xA831C66D, 0xB00327C8, 0xBF597FC7, 0xC6E00BF3, 0xD5A79147, 0x06CA6351, 0x14292967,
+    0x27B70A85, 0x2E1B2138, 0x4D2C6DFC, 0x53380D13, 0x650A7354, 0x766A0ABB, 0x81C2C92E, 0x92722C85,
+    0xA2BFE8A1, 0xA81A664B, 0xC24B8B70, 0xC76C51A3, 0xD192E819, 0xD6990624, 0xF40E3585, 0x106AA070,
+    0x19A4C116, 0x1E376C08, 0x2748774C, 0x34B0BCB5, 0x391C0CB3, 0x4ED8AA4A, 0x5B9CCA4F, 0x682E6FF3,
+    0x748F82EE, 0x78A5636F, 0x84C87814, 0x8CC70208, 0x90BEFFFA, 0xA4506CEB, 0xBEF9A3F7, 0xC67178F2,
+))
+# fmt: on
+
+# Message schedule shared by all hash objects, a block is always
+# compressed in one go so it never holds state between calls
+_W = array("L", [0] * 64)
+
+
+def _compress(state, block, offset):
+    """Compress the 64 bytes of block at offset into the 8 words of state."""
+    w = _W
+    k = _K
+    for i in range(16):
+        j = offset + 4 * i
+        w[i] = (block[j] << 24) | (block[j + 1] << 16) | (block[j + 2] << 8) | block[j + 3]
+    for i in range(16, 64):
+        x = w[i - 15]
+        s0 = (x >> 7 | x << 25) ^ (x >> 18 | x << 14) ^ (x >> 3)
+        x = w[i - 2]
+        s1 = (x >> 17 | x << 15) ^ (x >> 19 | x << 13) ^ (x >> 10)
+        w[i] = (w[i - 16] + s0 + w[i - 7] + s1) & 0xFFFFFFFF
+
+    a, b, c, d, e, f, g, h = state
+    for i in range(64):
+        # Bits shifted above bit 31 only reach bits above 31 of the
+        # sums, so a single mask per new word is enough
+        t1 = h + ((e >> 6 | e << 26) ^ (e >> 11 | e << 21) ^ (e >> 25 | e << 7)) + (g ^ (e & (f ^ g))) + k[i] + w[i]
+        t2 = ((a >> 2 | a << 30) ^ (a >> 13 | a << 19) ^ (a >> 22 | a << 10)) + ((a & b) | (c & (a | b)))
+        h = g
+        g = f
+        f = e
+        e = (d + t1) & 0xFFFFFFFF
+        d = c
+        c = b
+        b = a
+        a = (t1 + t2) & 0xFFFFFFFF
+
+    state[0] = (state[0] + a) & 0xFFFFFFFF
+    state[1] = (state[1] + b) & 0xFFFFFFFF
+    state[2] = (state[2] + c) & 0xFFFFFFFF
+    state[3] = (state[3] + d) & 0xFFFFFFFF
+    state[4] = (state[4] + e) & 0xFFFFFFFF
+    state[5] = (state[5] + f) & 0xFFFFFFFF
+    state[6] = (state[6] + g) & 0xFFFFFFFF
+    state[7] = (state[7] + h) & 0xFFFFFFFF
+
+
+# pylint: disable=protected-access
+class sha256:
+    digest_size = digestsize = SHA_DIGESTSIZE
+    block_size = SHA_BLOCKSIZE
+    name = "sha256"
+    _iv = (0x6A09E667, 0xBB67AE85, 0x3C6EF372, 0xA54FF53A, 0x510E527F, 0x9B05688C, 0x1F83D9AB, 0x5BE0CD19)
+
+    def __init__(self, s: Optional[Union[str, bytes]] = None):
+        """Constructs a SHA256 hash object."""
+        self._state = array("L", self._iv)
+        self._buffer = bytearray(SHA_BLOCKSIZE)
+        self._local = 0
+        self._count = 0
+        if s:
+            self.update(s)
+
+    def update(self, s: Union[str, bytes]):
+        """Updates the hash object with a bytes-like object, s."""
+        if isinstance(s, str):
+            s = s.encode("ascii")
+        data = memoryview(s)
+        size = len(data)
+        self._count += size
+        index = 0
+
+        if self._local:
+            take = min(SHA_BLOCKSIZE - self._local, size)
+            self._buffer[self._local : self._local + take] = data[:take]
+            self._local += take
+            index = take
+            if self._local < SHA_BLOCKSIZE:
+                return
+            _compress(self._state, self._buffer, 0)
+            self._local = 0
+
+        while size - index >= SHA_BLOCKSIZE:
+            _compress(self._state, data, index)
+            index += SHA_BLOCKSIZE
+
+        self._local = size - index
+        self._buffer[: self._local] = data[index:]
+
+    def digest(self):
+        """Returns the digest of the data passed to the update()
+        method so far."""
+        final = self.copy()
+        count = self._count
+        final.update(b"\x80" + bytes((55 - count) % SHA_BLOCKSIZE) + struct.pack(">Q", count << 3))
+        return struct.pack(">8I", *final._state)[: self.digest_size]
+
+    def hexdigest(self):
+        """Like digest() except the digest is returned as a string object of
+        double length, containing only hexadecimal digits.
+        """
+        return "".join(["%.2x" % i for i in self.digest()])
+
+    def copy(self):
+        """Return a copy (“clone”) of the hash object."""
+        new = self.__class__()
+        new._state = array("L", self._state)
+        new._buffer = bytearray(self._buffer)
+        new._local = self._local
+        new._count = self._count
+        return new
+
+
+class sha224(sha256):
+    digest_size = digestsize = 28
+    name = "sha224"
+    _iv = (0xC1059ED8, 0x367CD507, 0x3070DD17, 0xF70E5939, 0xFFC00B31, 0x68581511, 0x64F98FA7, 0xBEFA4FA4)
@@ -0,0 +1,178 @@
+# SPDX-FileCopyrightText: 2017 Paul Sokolovsky
+# SPDX-FileCopyrightText: 2019 Brent Rubell for Adafruit Industries
+#
+# SPDX-License-Identifier: MIT
+
+"""
+`_sha512_fast.py`
+======================================================
+Word-oriented SHA-512 and SHA-384 engine, the 64-bit counterpart of
+``_sha256_fast``. The message schedule is preallocated, rotations are
+written out inline and blocks are read straight from the caller's buffer
+through a memoryview, so compressing a block allocates no lists, dicts or
+closures besides the integers themselves.
+* Author(s): Tom St Denis, Paul Sokolovsky, Brent Rubell
+"""
+# pylint: disable=invalid-name, too-many-locals, missing-docstring
+
+import struct
+
+try:
+    from typing import Optional, Union
+except ImportError:
+    # suppress because typing does not exist on circuitpython
+    pass
+
+SHA_BLOCKSIZE = 128
+SHA_DIGESTSIZE = 64
+
+_MASK = 0xFFFFFFFFFFFFFFFF
+
+# fmt: off
+_K = (
+    0x428A2F98D728AE22, 0x7137449123EF65CD, 0xB5C0FBCFEC4D3B2F, 0xE9B5DBA58189DBBC,
+    0x3956C25BF348B538, 0x59F111F1B605D019, 0x923F82A4AF194F9B, 0xAB1C5ED5DA6D8118,
+    0xD807AA98A3030242, 0x12835B0145706FBE, 0x243185BE4EE4B28C, 0x550C7DC3D5FFB4E2,
+    0x72BE5D74F27B896F, 0x80DEB1FE3B1696B1, 0x9BDC06A725C71235, 0xC19BF174CF692694,
+    0xE49B69C19EF14AD2, 0xEFBE4786384F25E3, 0x0FC19DC68B8CD5B5, 0x240CA1CC77AC9C65,
+    0x2DE92C6F592B0275, 0x4A7484AA6EA6E483, 0x5CB0A9DCBD41FBD4, 0x76F988DA831153B5,
+    0x983E5152EE66DFAB, 0xA831C66D2DB43210, 0xB00327C898FB213F, 0xBF597FC7BEEF0EE4,
+    0xC6E00BF33DA88FC2, 0xD5A79147930AA725, 0x06CA6351E003826F, 0x142929670A0E6E70,
+    0x27B70A8546D22FFC, 0x2E1B21385C26C926, 0x4D2C6DFC5AC42AED, 0x53380D139D95B3DF,
+    0x650A73548BAF63DE, 0x766A0ABB3C77B2A8, 0x81C2C92E47EDAEE6, 0x92722C851482353B,
+    0xA2BFE8A14CF10364, 0xA81A664BBC423001, 0xC24B8B70D0F89791, 0xC76C51A30654BE30,
+    0xD192E819D6EF5218, 0xD69906245565A910, 0xF40E35855771202A, 0x106AA07032BBD1B8,
+    0x19A4C116B8D2D0C8, 0x1E376C085141AB53, 0x2748774CDF8EEB99, 0x34B0BCB5E19B48A8,
+    0x391C0CB3C5C95A63, 0x4ED8AA4AE3418ACB, 0x5B9CCA4F7763E373, 0x682E6FF3D6B2B8A3,
+    0x748F82EE5DEFB2FC, 0x78A5636F43172F60, 0x84C87814A1F0AB72, 0x8CC702081A6439EC,
+    0x90BEFFFA23631E28, 0xA4506CEBDE82BDE9, 0xBEF9A3F7B2C67915, 0xC67178F2E372532B,
+    0xCA273ECEEA26619C, 0xD186B8C721C0C207, 0xEADA7DD6CDE0EB1E, 0xF57D4F7FEE6ED178,
+    0x06F067AA72176FBA, 0x0A637DC5A2C898A6, 0x113F9804BEF90DAE, 0x1B710B35131C471B,
+    0x28DB77F523047D84, 0x32CAAB7B40C72493, 0x3C9EBE0A15C9BEBC, 0x431D67C49C100D4C,
+    0x4CC5D4BECB3E42B6, 0x597F299CFC657E2A, 0x5FCB6FAB3AD6FAEC, 0x6C44198C4A475817,
+)
+# fmt: on
+
+# Message schedule shared by all hash objects, a block is always
+# compressed in one go so it never holds state between calls. 64-bit
+# words do not fit a small int on the device, so a list holding the
+# integers beats an array('Q') that would box a new one on every read.
+_W = [0] * 80
+
+
+def _compress(state, block, offset):
+    """Compress the 128 bytes of block at offset into the 8 words of state."""
+    w = _W
+    k = _K
+    i = 0
+    for x in struct.unpack_from(">16Q", block, offset):
+        w[i] = x
+        i += 1
+    for i in range(16, 80):
+        x = w[i - 15]
+        s0 = (x >> 1 | x << 63) ^ (x >> 8 | x << 56) ^ (x >> 7)
+        x = w[i - 2]
+        s1 = (x >> 19 | x << 45) ^ (x >> 61 | x << 3) ^ (x >> 6)
+        w[i] = (w[i - 16] + s0 + w[i - 7] + s1) & _MASK
+
+    a, b, c, d, e, f, g, h = state
+    for i in range(80):
+        # Bits shifted above bit 63 only reach bits above 63 of the
+        # sums, so a single mask per new word is enough
+        t1 = h + ((e >> 14 | e << 50) ^ (e >> 18 | e << 46) ^ (e >> 41 | e << 23)) + (g ^ (e & (f ^ g))) + k[i] + w[i]
+        t2 = ((a >> 28 | a << 36) ^ (a >> 34 | a << 30) ^ (a >> 39 | a << 25)) + ((a & b) | (c & (a | b)))
+        h = g
+        g = f
+        f = e
+        e = (d + t1) & _MASK
+        d = c
+        c = b
+        b = a
+        a = (t1 + t2) & _MASK
+
+    state[0] = (state[0] + a) & _MASK
+    state[1] = (state[1] + b) & _MASK
+    state[2] = (state[2] + c) & _MASK
+    state[3] = (state[3] + d) & _MASK
+    state[4] = (state[4] + e) & _MASK
+    state[5] = (state[5] + f) & _MASK
+    state[6] = (state[6] + g) & _MASK
+    state[7] = (state[7] + h) & _MASK
+
+
+# pylint: disable=protected-access
+class sha512:
+    digest_size = digestsize = SHA_DIGESTSIZE
+    block_size = SHA_BLOCKSIZE
+    name = "sha512"
+    _iv = (
+        0x6A09E667F3BCC908, 0xBB67AE8584CAA73B, 0x3C6EF372FE94F82B, 0xA54FF53A5F1D36F1,
+        0x510E527FADE682D1, 0x9B05688C2B3E6C1F, 0x1F83D9ABFB41BD6B, 0x5BE0CD19137E2179,
+    )
+
+    def __init__(self, s: Optional[Union[str, bytes]] = None):
+        """Constructs a SHA512 hash object."""
+        self._state = list(self._iv)
+        self._buffer = bytearray(SHA_BLOCKSIZE)
+        self._local = 0
+        self._count = 0
+        if s:
+            self.update(s)
+
+    def update(self, s: Union[str, bytes]):
+        """Updates the hash object with a bytes-like object, s."""
+        if isinstance(s, str):
+            s = s.encode("ascii")
+        data = memoryview(s)
+        size = len(data)
+        self._count += size
+        index = 0
+
+        if self._local:
+            take = min(SHA_BLOCKSIZE - self._local, size)
+            self._buffer[self._local : self._local + take] = data[:take]
+            self._local += take
+            index = take
+            if self._local < SHA_BLOCKSIZE:
+                return
+            _compress(self._state, self._buffer, 0)
+            self._local = 0
+
+        while size - index >= SHA_BLOCKSIZE:
+            _compress(self._state, data, index)
+            index += SHA_BLOCKSIZE
+
+        self._local = size - index
+        self._buffer[: self._local] = data[index:]
+
+    def digest(self):
+        """Returns the digest of the data passed to the update()
+        method so far."""
+        final = self.copy()
+        count = self._count
+        final.update(b"\x80" + bytes((111 - count) % SHA_BLOCKSIZE) + struct.pack(">QQ", count >> 61, (count << 3) & _MASK))
+        return struct.pack(">8Q", *final._state)[: self.digest_size]
+
+    def hexdigest(self):
+        """Like digest() except the digest is returned as a string object of
+        double length, containing only hexadecimal digits.
+        """
+        return "".join(["%.2x" % i for i in self.digest()])
+
+    def copy(self):
+        """Return a copy (“clone”) of the hash object."""
+        new = self.__class__()
+        new._state = list(self._state)
+        new._buffer = bytearray(self._buffer)
+        new._local = self._local
+        new._count = self._count
+        return new
+
+
+class sha384(sha512):
+    digest_size = digestsize = 48
+    name = "sha384"
+    _iv = (
+        0xCBBB9D5DC1059ED8, 0x629A292A367CD507, 0x9159015A3070DD17, 0x152FECD8F70E5939,
+        0x67332667FFC00B31, 0x8EB44A8768581511, 0xDB0C2E0D64F98FA7, 0x47B5481DBEFA4FA4,
+    )
@@ -0,0 +1,104 @@
+import os
+import struct
+from vault import VAULT_FILE, replace_file
+
+LOCKOUT_FILE = "lockout.bin"
+LOCKOUT_MAGIC = b"G8KL"
+LOCKOUT_VERSION = 1
+
+# State: magic, version, failed unlock attempts in a row and the RTC time
+# in seconds of the latest one. An attempt is counted before the key is
+# derived and only cleared once it succeeded, so cutting the power during
+# the KDF does not give a free try. Once a vault exists the file is kept
+# with a zero count instead of being deleted, so deleting it does not
+# reset the count either.
+LOCKOUT_FORMAT = "<4sBII"
+LOCKOUT_SIZE = struct.calcsize(LOCKOUT_FORMAT)
+
+# Failed attempts allowed without a delay, after that the delay doubles
+# with every failure from LOCKOUT_BASE_DELAY up to LOCKOUT_MAX_DELAY seconds
+LOCKOUT_FREE_ATTEMPTS = 3
+LOCKOUT_BASE_DELAY = 30
+LOCKOUT_MAX_DELAY = 24 * 60 * 60
+
+# Latest attempt time read back for a missing or damaged file. It is
+# later than any RTC time, so next_attempt_time() takes it for a clock that
+# was set back and restarts the delay from now.
+LOCKOUT_UNKNOWN_TIME = 0xFFFFFFFF
+
+
+def _exists(path):
+    try:
+        os.stat(path)
+        return True
+    except OSError:
+        return False
+
+
+def _read(path):
+    # (failures, last attempt time). A power cut in replace_file() can
+    # leave only the new state in the .tmp file. A damaged file, e.g. from
+    # a power cut while it was written, or none at all next to a vault has
+    # used up the free attempts, and its latest attempt was just now.
+    data = None
+    for candidate in (path, path + ".tmp"):
+        try:
+            with open(candidate, "rb") as file:
+                data = file.read()
+            break
+        except OSError:
+            pass
+    if data is None:
+        if not _exists(VAULT_FILE):
+            return 0, 0
+        return LOCKOUT_FREE_ATTEMPTS, LOCKOUT_UNKNOWN_TIME
+    if len(data) == LOCKOUT_SIZE:
+        magic, version, failures, last_attempt = struct.unpack(LOCKOUT_FORMAT, data)
+        if magic == LOCKOUT_MAGIC and version == LOCKOUT_VERSION:
+            return failures, last_attempt
+    return LOCKOUT_FREE_ATTEMPTS, LOCKOUT_UNKNOWN_TIME
+
+
+def _write(failures, last_attempt, path):
+    temp_path = path + ".tmp"
+    with open(temp_path, "wb") as file:
+        file.write(struct.pack(LOCKOUT_FORMAT, LOCKOUT_MAGIC, LOCKOUT_VERSION, failures, last_attempt))
+    replace_file(temp_path, path)
+
+
+def lockout_delay(failures):
+    """Seconds to wait after failures failed attempts in a row."""
+    if failures < LOCKOUT_FREE_ATTEMPTS:
+        return 0
+    return min(LOCKOUT_BASE_DELAY << min(failures - LOCKOUT_FREE_ATTEMPTS, 16), LOCKOUT_MAX_DELAY)
+
+
+def next_attempt_time(now, path=LOCKOUT_FILE):
+    """
+    Return the RTC time in seconds from which the next unlock attempt is
+    allowed. If the clock is now behind the latest attempt it was set
+    back, and the delay restarts from now instead of stretching.
+    """
+    failures, last_attempt = _read(path)
+    delay = lockout_delay(failures)
+    if not delay:
+        return 0
+    if now < last_attempt:
+        last_attempt = now
+        _write(failures, last_attempt, path)
+    return last_attempt + delay
+
+
+def begin_attempt(now, path=LOCKOUT_FILE):
+    """
+    Count an unlock attempt as failed until end_attempt() is called.
+    Returns the number of failures including this one.
+    """
+    failures = _read(path)[0] + 1
+    _write(failures, now, path)
+    return failures
+
+
+def end_attempt(path=LOCKOUT_FILE):
+    """Clear the failure count after a successful unlock."""
+    _write(0, 0, path)
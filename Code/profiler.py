@@ -0,0 +1,110 @@
+import time
+from array import array
+
+# Lightweight timing spans for finding where the seconds go on the device.
+# Every span is a name, a start time and a duration, kept in a fixed-size
+# ring so profiling never allocates more as the session goes on and only
+# the most recent PROFILE_RING_SIZE spans are remembered. Screens redraw
+# many times a second and push slow one-off spans out of the ring, so
+# calls, total and longest time are also summed up per name. Times are
+# in microseconds, the ring keeps them truncated to 32 bits.
+
+# Set to False to make profiled() return functions undecorated
+PROFILE_ENABLED = True
+PROFILE_RING_SIZE = 64
+
+_names = [None] * PROFILE_RING_SIZE
+_starts = array("L", [0] * PROFILE_RING_SIZE)
+_durations = array("L", [0] * PROFILE_RING_SIZE)
+_next = 0
+_count = 0
+# name -> [calls, total_us, max_us] since boot or clear_spans()
+_totals = {}
+
+
+def record_span(name, start_ns, end_ns=None):
+    """
+    Store a span that started at start_ns (time.monotonic_ns()) and ended
+    at end_ns, or now. Overwrites the oldest span once the ring is full.
+    """
+    global _next, _count
+    if not PROFILE_ENABLED:
+        return
+    if end_ns is None:
+        end_ns = time.monotonic_ns()
+    duration = (end_ns - start_ns) // 1000
+    _names[_next] = name
+    _starts[_next] = (start_ns // 1000) & 0xFFFFFFFF
+    _durations[_next] = min(duration, 0xFFFFFFFF)
+    _next = (_next + 1) % PROFILE_RING_SIZE
+    if _count < PROFILE_RING_SIZE:
+        _count += 1
+    totals = _totals.get(name)
+    if totals is None:
+        _totals[name] = [1, duration, duration]
+    else:
+        totals[0] += 1
+        totals[1] += duration
+        if duration > totals[2]:
+            totals[2] = duration
+
+
+def profiled(name):
+    """
+    Decorator recording every call of the function as a span called name,
+    exceptions included.
+    """
+    def decorate(function):
+        if not PROFILE_ENABLED:
+            return function
+
+        def wrapper(*args, **kwargs):
+            start = time.monotonic_ns()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                record_span(name, start)
+        return wrapper
+    return decorate
+
+
+def spans():
+    """Return the recorded spans as (name, start_us, duration_us), oldest first."""
+    first = (_next - _count) % PROFILE_RING_SIZE
+    result = []
+    for i in range(_count):
+        index = (first + i) % PROFILE_RING_SIZE
+        result.append((_names[index], _starts[index], _durations[index]))
+    return result
+
+
+def span_summary():
+    """
+    Return (name, calls, total_us, max_us) for every span name recorded
+    since boot or clear_spans(), the most time consuming first.
+    """
+    result = [(name, calls, total, longest) for name, (calls, total, longest) in _totals.items()]
+    result.sort(key=lambda row: row[2], reverse=True)
+    return result
+
+
+def dump_spans(report=print):
+    """
+    Write the spans and their summary as CSV lines, by default to the
+    serial console.
+    """
+    report(f"# spans {_count}/{PROFILE_RING_SIZE}")
+    report("name,start_us,duration_us")
+    for name, start, duration in spans():
+        report(f"{name},{start},{duration}")
+    report("name,calls,total_us,max_us")
+    for name, calls, total, longest in span_summary():
+        report(f"{name},{calls},{total},{longest}")
+
+
+def clear_spans():
+    """Forget all spans and totals."""
+    global _next, _count
+    _next = 0
+    _count = 0
+    _totals.clear()
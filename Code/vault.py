@@ -0,0 +1,1088 @@
+import binascii
+import os
+import struct
+from array import array
+from encryption import KDF_LEGACY, WRAPPED_KEY_SIZE, Sealer, unwrap_key, wrap_key
+
+VAULT_FILE = "vault.bin"
+JOURNAL_FILE = "vault.jnl"
+VAULT_MAGIC = b"G8KV"
+VAULT_VERSION = 1
+
+# Header: magic, format version, flags, header size, record count,
+# generation, the offset and length of the encrypted names blob, the
+# KDF id, iteration count and salt the pattern key is derived with, and
+# the data key wrapped under the pattern key. Names and secrets are
+# encrypted with the data key, so a new pattern key only wraps that key
+# again. The vault is still committed as a new generation, with the
+# records copied over as ciphertext. The header size field lets later
+# versions append fields without breaking readers, records always start
+# at header_size. KDF_LEGACY in the KDF field means
+# the key comes from salt.bin and encryption.LEGACY_ITERATIONS, as for
+# vaults converted from encrypted_passwords.csv.
+HEADER_PREFIX_FORMAT = "<4sBBH"
+HEADER_PREFIX_SIZE = struct.calcsize(HEADER_PREFIX_FORMAT)
+HEADER_FORMAT = "<4sBBHIIIIII16s48s"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+GENERATION_OFFSET = HEADER_PREFIX_SIZE + 4
+KDF_FORMAT = "<II16s"
+KDF_OFFSET = struct.calcsize("<4sBBHIIII")
+WRAPPED_KEY_OFFSET = KDF_OFFSET + struct.calcsize(KDF_FORMAT)
+
+# Trailer: CRC32 over the records and names blob followed by the header.
+# It catches torn writes, the seals below are what catch tampering.
+CRC_FORMAT = "<I"
+CRC_SIZE = struct.calcsize(CRC_FORMAT)
+
+# Record prefix: secret length. The secret is a sealed record from
+# encryption.Sealer (nonce, AES-CTR ciphertext, truncated HMAC tag).
+RECORD_FORMAT = "<H"
+RECORD_SIZE = struct.calcsize(RECORD_FORMAT)
+
+# Names blob: site and username of every record, each pair prefixed with
+# both lengths, sealed as one message so unlocking costs one AES pass and
+# one MAC over all names instead of one per field
+NAMES_FORMAT = "<BB"
+NAMES_SIZE = struct.calcsize(NAMES_FORMAT)
+
+# Associated data bound into the tag of everything sealed with the data
+# key, the first byte keeps the kinds apart. A record's secret covers its
+# site and username in names blob layout, so it cannot be moved to another
+# entry, and the names of a journal record cover its op, entry index and
+# vault generation, so records cannot be retargeted or replayed.
+RECORD_ASSOCIATED = b"R"
+NAMES_ASSOCIATED = b"N"
+JOURNAL_ASSOCIATED_FORMAT = "<cBII"
+
+# Packed names a VaultWriter holds in RAM before sealing them out to a
+# side file, so writing a large vault needs bounded memory
+NAMES_FLUSH_SIZE = 512
+
+MAX_NAME_LENGTH = 0xFF
+MAX_SECRET_LENGTH = 0xFFFF
+
+# Journal: append-only log of changes since the vault was last compacted.
+# The header names the vault generation it applies to. Each record is
+# prefixed with op, entry index, names and secret lengths, followed by the
+# sealed names of the entry (empty for a delete), the secret and a CRC32.
+# Secrets are sealed like vault secrets.
+JOURNAL_MAGIC = b"G8KJ"
+JOURNAL_VERSION = 1
+JOURNAL_HEADER_FORMAT = "<4sBI"
+JOURNAL_HEADER_SIZE = struct.calcsize(JOURNAL_HEADER_FORMAT)
+JOURNAL_RECORD_FORMAT = "<BIHH"
+JOURNAL_RECORD_SIZE = struct.calcsize(JOURNAL_RECORD_FORMAT)
+JOURNAL_ADD, JOURNAL_UPDATE, JOURNAL_DELETE = 1, 2, 3
+
+# Journal length at which the vault is rewritten and the journal cleared
+JOURNAL_COMPACT_THRESHOLD = 32
+
+# Number of decrypted passwords kept in RAM while the device is unlocked
+PLAINTEXT_CACHE_SIZE = 8
+
+# Entries passed through the cipher together by full walks, each batch
+# shares one output buffer
+CIPHER_BATCH_SIZE = 16
+
+
+def _sync():
+    if hasattr(os, "sync"):
+        os.sync()
+
+
+def replace_file(source, target):
+    try:
+        os.remove(target)
+    except OSError:
+        pass
+    os.rename(source, target)
+
+
+def _read_header(file):
+    prefix = file.read(HEADER_PREFIX_SIZE)
+    if len(prefix) != HEADER_PREFIX_SIZE:
+        raise ValueError("Truncated vault header")
+    magic, version, flags, header_size = struct.unpack(HEADER_PREFIX_FORMAT, prefix)
+    if magic != VAULT_MAGIC:
+        raise ValueError("Not a vault file")
+    if version != VAULT_VERSION:
+        raise ValueError(f"Unsupported vault version: {version}")
+    if header_size < HEADER_SIZE:
+        raise ValueError("Truncated vault header")
+    header = prefix + file.read(header_size - HEADER_PREFIX_SIZE)
+    if len(header) != header_size:
+        raise ValueError("Truncated vault header")
+    count, generation, names_offset, names_length = struct.unpack_from("<IIII", header, HEADER_PREFIX_SIZE)
+    return flags, count, generation, names_offset, names_length, header
+
+
+def _kdf_params(header):
+    # (kdf, iterations, salt), or None when the key uses the legacy
+    # parameters kept outside the vault
+    kdf, iterations, salt = struct.unpack_from(KDF_FORMAT, header, KDF_OFFSET)
+    if kdf == KDF_LEGACY:
+        return None
+    return kdf, iterations, salt
+
+
+def _wrapped_key(header):
+    # The wrapped data key, or None if the header holds none
+    wrapped = header[WRAPPED_KEY_OFFSET:WRAPPED_KEY_OFFSET + WRAPPED_KEY_SIZE]
+    if not any(wrapped):
+        return None
+    return wrapped
+
+
+def _lower_bound(key_at, count, key):
+    low, high = 0, count
+    while low < high:
+        middle = (low + high) // 2
+        if key_at(middle) < key:
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+
+def _sift_down(values, less, start, end):
+    # Move values[start] down the max-heap in values[:end]
+    item = values[start]
+    root = start
+    while True:
+        child = 2 * root + 1
+        if child >= end:
+            break
+        if child + 1 < end and less(values[child], values[child + 1]):
+            child += 1
+        if not less(item, values[child]):
+            break
+        values[root] = values[child]
+        root = child
+    values[root] = item
+
+
+def _heapsort(values, less):
+    # Sort values in place, less(a, b) is true if a goes before b and
+    # must not hold for equal values. Needs no memory besides what less
+    # uses for the two values being compared.
+    count = len(values)
+    for start in range(count // 2 - 1, -1, -1):
+        _sift_down(values, less, start, count)
+    for end in range(count - 1, 0, -1):
+        values[0], values[end] = values[end], values[0]
+        _sift_down(values, less, 0, end)
+
+
+def _sort_prefix(key):
+    # The first bytes of a search key as an int, a key that sorts first
+    # never gets a larger one. Shifted to stay a small int on CircuitPython.
+    key = key[:4]
+    return int.from_bytes(key + bytes(4 - len(key)), "big") >> 2
+
+
+def _encode_name(name):
+    data = name.encode() if isinstance(name, str) else bytes(name)
+    if len(data) > MAX_NAME_LENGTH:
+        raise ValueError(f"Name too long: {len(data)} bytes")
+    return data
+
+
+def _pack_names(buffer, site, username):
+    site = _encode_name(site)
+    username = _encode_name(username)
+    buffer.extend(struct.pack(NAMES_FORMAT, len(site), len(username)))
+    buffer.extend(site)
+    buffer.extend(username)
+
+
+def _record_associated(site, username):
+    associated = bytearray(RECORD_ASSOCIATED)
+    _pack_names(associated, site, username)
+    return associated
+
+
+def seal_records(sealer, rows):
+    """
+    Seal the passwords of a list of (site, username, password bytes) rows
+    with the encryption.Sealer sealer of the vault's data key. Yields the
+    (site, username, secret) records VaultWriter and
+    PasswordEntries.compact() take.
+    """
+    secrets = sealer.seal_batch([row[2] for row in rows], [_record_associated(row[0], row[1]) for row in rows])
+    for index, row in enumerate(rows):
+        yield row[0], row[1], secrets[index]
+
+
+def _remove_at(values, index):
+    # array has no pop() on CircuitPython
+    return values[:index] + values[index + 1:]
+
+
+class NameTable:
+    """
+    Site and username names of a list of entries, packed into a single
+    bytearray arena in names blob layout with an array of offsets. This
+    costs a few bytes per entry instead of a tuple and two str objects,
+    and the plaintext can be zeroed by clear(). Replaced names stay in the
+    arena until the table is rebuilt.
+    """
+
+    def __init__(self, data=b""):
+        self._arena = data if isinstance(data, bytearray) else bytearray(data)
+        self._offsets = array("L")
+        offset = 0
+        while offset < len(self._arena):
+            self._offsets.append(offset)
+            site_length, username_length = struct.unpack_from(NAMES_FORMAT, self._arena, offset)
+            offset += NAMES_SIZE + site_length + username_length
+        if offset != len(self._arena):
+            raise ValueError("Truncated names blob")
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def __getitem__(self, index):
+        offset = self._offsets[index]
+        site_length, username_length = struct.unpack_from(NAMES_FORMAT, self._arena, offset)
+        offset += NAMES_SIZE
+        site = bytes(self._arena[offset:offset + site_length]).decode()
+        offset += site_length
+        return site, bytes(self._arena[offset:offset + username_length]).decode()
+
+    def has_username(self, index):
+        return self._arena[self._offsets[index] + 1] != 0
+
+    def encoded(self, index, field):
+        # Site (field 0) or username (field 1) at index, as UTF-8 bytes
+        offset = self._offsets[index]
+        site_length, username_length = struct.unpack_from(NAMES_FORMAT, self._arena, offset)
+        offset += NAMES_SIZE
+        if field:
+            return bytes(self._arena[offset + site_length:offset + site_length + username_length])
+        return bytes(self._arena[offset:offset + site_length])
+
+    def packed(self, index):
+        # The pair at index in names blob layout, without decoding it
+        offset = self._offsets[index]
+        site_length, username_length = struct.unpack_from(NAMES_FORMAT, self._arena, offset)
+        return self._arena[offset:offset + NAMES_SIZE + site_length + username_length]
+
+    def __setitem__(self, index, name):
+        self._offsets[index] = len(self._arena)
+        _pack_names(self._arena, name[0], name[1])
+
+    def __iter__(self):
+        for index in range(len(self._offsets)):
+            yield self[index]
+
+    def append(self, name):
+        self._offsets.append(len(self._arena))
+        _pack_names(self._arena, name[0], name[1])
+
+    def pop(self, index):
+        name = self[index]
+        self._offsets = _remove_at(self._offsets, index)
+        return name
+
+    def clear(self):
+        for index in range(len(self._arena)):
+            self._arena[index] = 0
+        self._arena = bytearray()
+        self._offsets = array("L")
+
+
+class Entry:
+    """
+    One decrypted vault entry as handed to the UI.
+    """
+
+    __slots__ = ("site", "username", "password")
+
+    def __init__(self, site, username, password):
+        self.site = site
+        self.username = username
+        self.password = password
+
+
+class VaultWriter:
+    """
+    Stream records into a new vault file. Secrets are written as they are
+    added. Names are sealed as one stream, kept in RAM for small vaults
+    and spilled to a side file in NAMES_FLUSH_SIZE steps for large ones.
+    The blob, header and checksum trailer are written on close.
+    kdf_params is the (kdf, iterations, salt) tuple recorded in the header,
+    None keeps the legacy parameters. sealer is the encryption.Sealer of
+    the data key the names are sealed with and wrapped_key its wrapped
+    copy for the header.
+    """
+
+    def __init__(self, path=VAULT_FILE, generation=1, sealer=None, kdf_params=None, wrapped_key=None):
+        self._path = path
+        self._kdf_params = kdf_params or (KDF_LEGACY, 0, bytes(16))
+        self._wrapped_key = wrapped_key or bytes(WRAPPED_KEY_SIZE)
+        self._file = open(path, "wb")
+        self._sealer = sealer
+        self._names = bytearray()
+        self._names_path = path + ".names"
+        self._names_file = None
+        self._names_writer = None
+        self.count = 0
+        self.generation = generation
+        self._crc = 0
+        self._file.write(bytes(HEADER_SIZE))
+
+    def _write(self, data):
+        self._file.write(data)
+        self._crc = binascii.crc32(data, self._crc)
+
+    def add(self, site, username, secret):
+        if len(secret) > MAX_SECRET_LENGTH:
+            raise ValueError(f"Secret too long: {len(secret)} bytes")
+        _pack_names(self._names, site, username)
+        self._write(struct.pack(RECORD_FORMAT, len(secret)))
+        self._write(secret)
+        self.count += 1
+        if len(self._names) >= NAMES_FLUSH_SIZE:
+            self._flush_names()
+
+    def _flush_names(self):
+        # Same layout as Sealer.seal(), the stream writer carries the
+        # keystream and the MAC between calls
+        if self._names_writer is None:
+            self._names_file = open(self._names_path, "wb")
+            self._names_writer = self._sealer.writer(self._names_file, NAMES_ASSOCIATED)
+        self._names_writer.write(self._names)
+        self._names = bytearray()
+
+    def _write_names(self):
+        if not self.count:
+            return 0
+        if self._names_file is None:
+            names = self._sealer.seal(self._names, NAMES_ASSOCIATED)
+            self._write(names)
+            return len(names)
+
+        self._flush_names()
+        self._names_writer.close()
+        self._names_writer = None
+        self._names_file.close()
+        self._names_file = None
+        length = 0
+        buffer = bytearray(256)
+        with open(self._names_path, "rb") as file:
+            while True:
+                read = file.readinto(buffer)
+                if not read:
+                    break
+                self._write(memoryview(buffer)[:read])
+                length += read
+        os.remove(self._names_path)
+        return length
+
+    def close(self):
+        if self._file is None:
+            return
+        names_offset = self._file.tell()
+        names_length = self._write_names()
+        self._names = None
+        kdf, iterations, salt = self._kdf_params
+        header = struct.pack(HEADER_FORMAT, VAULT_MAGIC, VAULT_VERSION, 0, HEADER_SIZE, self.count, self.generation, names_offset, names_length, kdf, iterations, salt, self._wrapped_key)
+        self._file.write(struct.pack(CRC_FORMAT, binascii.crc32(header, self._crc)))
+        self._file.seek(0)
+        self._file.write(header)
+        self._file.flush()
+        self._file.close()
+        self._file = None
+
+    def abort(self):
+        """Close and delete the unfinished file, it must never look like a valid generation."""
+        for file, path in ((self._names_file, self._names_path), (self._file, self._path)):
+            if file is not None:
+                file.close()
+                os.remove(path)
+        self._names_file = None
+        self._names_writer = None
+        self._file = None
+        self._names = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class VaultReader:
+    """
+    Random access to the secrets of a vault file. Opening only walks the
+    record prefixes to build an offset table, secrets are read from flash
+    when requested and names are opened in one go by names().
+    """
+
+    def __init__(self, path=VAULT_FILE):
+        self._file = open(path, "rb")
+        try:
+            self._read_index()
+        except Exception:
+            self._file.close()
+            raise
+
+    def _read_index(self):
+        self.flags, count, self.generation, self._names_offset, self._names_length, header = _read_header(self._file)
+        self.kdf_params = _kdf_params(header)
+        self.wrapped_key = _wrapped_key(header)
+
+        self._offsets = array("L")
+        prefix = bytearray(RECORD_SIZE)
+        offset = len(header)
+        for _ in range(count):
+            self._file.seek(offset)
+            if self._file.readinto(prefix) != len(prefix):
+                raise ValueError("Truncated vault record")
+            self._offsets.append(offset)
+            offset += RECORD_SIZE + struct.unpack(RECORD_FORMAT, prefix)[0]
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def secret(self, index):
+        """
+        Return the encrypted secret of the record at index.
+        """
+        self._file.seek(self._offsets[index])
+        secret_length = struct.unpack(RECORD_FORMAT, self._file.read(RECORD_SIZE))[0]
+        secret = self._file.read(secret_length)
+        if len(secret) != secret_length:
+            raise ValueError("Truncated vault record")
+        return secret
+
+    def names(self, sealer):
+        """
+        Return a NameTable of (site, username) for every record. Raises
+        ValueError if the names blob does not open with the
+        encryption.Sealer sealer.
+        """
+        if not self._names_length:
+            names = NameTable()
+        else:
+            self._file.seek(self._names_offset)
+            names = NameTable(sealer.open(self._file.read(self._names_length), NAMES_ASSOCIATED))
+        if len(names) != len(self._offsets):
+            raise ValueError("Names blob does not match record count")
+        return names
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def verify_vault(path=VAULT_FILE):
+    """
+    Return the generation of a complete vault file whose checksum matches,
+    or None if it is missing, truncated or corrupt.
+    """
+    try:
+        with open(path, "rb") as file:
+            _, _, generation, _, _, header = _read_header(file)
+            remaining = os.stat(path)[6] - len(header) - CRC_SIZE
+            if remaining < 0:
+                return None
+            buffer = bytearray(256)
+            view = memoryview(buffer)
+            crc = 0
+            while remaining:
+                read = file.readinto(view[:min(remaining, len(buffer))])
+                if not read:
+                    return None
+                crc = binascii.crc32(view[:read], crc)
+                remaining -= read
+            stored = struct.unpack(CRC_FORMAT, file.read(CRC_SIZE))[0]
+            if binascii.crc32(header, crc) != stored:
+                return None
+            return generation
+    except OSError:
+        return None
+    except ValueError as e:
+        print(f"Invalid vault {path}: {e}")
+        return None
+
+
+def read_kdf_params(path=VAULT_FILE):
+    """
+    Return the (kdf, iterations, salt) the key of the vault at path is
+    derived with, or None for a vault that uses the legacy parameters.
+    """
+    try:
+        with open(path, "rb") as file:
+            header = _read_header(file)[-1]
+    except OSError:
+        return None
+    return _kdf_params(header)
+
+
+def read_wrapped_key(path=VAULT_FILE):
+    """
+    Return the wrapped data key of the vault at path, or None when there
+    is no readable vault. Its tag verifies the pattern key before the
+    vault is opened.
+    """
+    try:
+        with open(path, "rb") as file:
+            header = _read_header(file)[-1]
+    except (OSError, ValueError):
+        return None
+    return _wrapped_key(header)
+
+
+def vault_generation(path=VAULT_FILE):
+    try:
+        with open(path, "rb") as file:
+            return _read_header(file)[2]
+    except (OSError, ValueError):
+        return 0
+
+
+def recover_vault(path=VAULT_FILE):
+    """
+    Make sure path holds the newest complete vault after a power loss in
+    the middle of a commit. Returns its generation, or None if there is no
+    valid vault at all.
+    """
+    best_path = None
+    best_generation = -1
+    for candidate in (path, path + ".tmp", path + ".old"):
+        generation = verify_vault(candidate)
+        if generation is not None and generation > best_generation:
+            best_path = candidate
+            best_generation = generation
+    if best_path is None:
+        return None
+    if best_path != path:
+        print(f"Recovering vault generation {best_generation} from {best_path}")
+        replace_file(best_path, path)
+        _sync()
+    return best_generation
+
+
+def _install_vault(temp_path, path, journal_path, generation):
+    # The new generation only replaces the current one once it has been
+    # read back and checksummed, the previous one is kept as path.old
+    if verify_vault(temp_path) != generation:
+        raise ValueError("Vault commit failed verification")
+    backup_path = path + ".old"
+    try:
+        os.remove(backup_path)
+    except OSError:
+        pass
+    try:
+        os.rename(path, backup_path)
+    except OSError:
+        pass
+    os.rename(temp_path, path)
+    reset_journal(journal_path, generation)
+    _sync()
+
+
+def reset_journal(path=JOURNAL_FILE, generation=0):
+    with open(path, "wb") as file:
+        file.write(struct.pack(JOURNAL_HEADER_FORMAT, JOURNAL_MAGIC, JOURNAL_VERSION, generation))
+
+
+class Journal:
+    """
+    Append-only change log kept next to the vault. A single add, update or
+    delete costs one record write, the vault itself is only rewritten when
+    the journal is compacted.
+    """
+
+    def __init__(self, path=JOURNAL_FILE, generation=0, sealer=None):
+        self._sealer = sealer
+        self._generation = generation
+        try:
+            self._file = open(path, "r+b")
+        except OSError:
+            reset_journal(path, generation)
+            self._file = open(path, "r+b")
+        self.count = 0
+        self.torn = False
+        self._end = JOURNAL_HEADER_SIZE
+
+        # A journal written against another vault generation was already
+        # folded in by a compaction that completed, or belongs to a vault
+        # that was rolled back, so it is discarded
+        header = self._file.read(JOURNAL_HEADER_SIZE)
+        if len(header) == JOURNAL_HEADER_SIZE:
+            magic, version, journal_generation = struct.unpack(JOURNAL_HEADER_FORMAT, header)
+        if len(header) != JOURNAL_HEADER_SIZE or magic != JOURNAL_MAGIC or version != JOURNAL_VERSION or journal_generation != generation:
+            self._file.close()
+            reset_journal(path, generation)
+            self._file = open(path, "r+b")
+
+    def replay(self, refs, names):
+        """
+        Apply the logged changes to refs, an array of record references as
+        used by PasswordEntries, and to the matching NameTable. Stops at
+        the first incomplete, corrupt or forged record.
+        """
+        prefix = bytearray(JOURNAL_RECORD_SIZE)
+        offset = JOURNAL_HEADER_SIZE
+        while True:
+            self._file.seek(offset)
+            read = self._file.readinto(prefix)
+            if not read:
+                break
+            if read != len(prefix):
+                self.torn = True
+                break
+            op, index, names_length, secret_length = struct.unpack(JOURNAL_RECORD_FORMAT, prefix)
+            body = self._file.read(names_length + secret_length + CRC_SIZE)
+            if len(body) != names_length + secret_length + CRC_SIZE:
+                self.torn = True
+                break
+            crc = binascii.crc32(body[:-CRC_SIZE], binascii.crc32(prefix))
+            if crc != struct.unpack(CRC_FORMAT, body[-CRC_SIZE:])[0]:
+                self.torn = True
+                break
+
+            try:
+                name = NameTable(self._sealer.open(body[:names_length], self._associated(op, index)))
+            except ValueError:
+                self.torn = True
+                break
+            if op != JOURNAL_DELETE:
+                if len(name) != 1:
+                    self.torn = True
+                    break
+                name = name[0]
+            if op == JOURNAL_ADD and index == len(refs):
+                refs.append(-offset - 1)
+                names.append(name)
+            elif op == JOURNAL_UPDATE and index < len(refs):
+                refs[index] = -offset - 1
+                names[index] = name
+            elif op == JOURNAL_DELETE and index < len(refs):
+                refs = _remove_at(refs, index)
+                names.pop(index)
+            else:
+                self.torn = True
+                break
+            offset += len(prefix) + len(body)
+            self.count += 1
+        self._end = offset
+        return refs, names
+
+    def _associated(self, op, index):
+        return struct.pack(JOURNAL_ASSOCIATED_FORMAT, b"J", op, index, self._generation)
+
+    def secret(self, offset):
+        self._file.seek(offset)
+        _, _, names_length, secret_length = struct.unpack(JOURNAL_RECORD_FORMAT, self._file.read(JOURNAL_RECORD_SIZE))
+        self._file.seek(names_length, 1)
+        return self._file.read(secret_length)
+
+    def append(self, op, index, site="", username="", secret=b""):
+        """
+        Write one change record and return its offset.
+        """
+        if len(secret) > MAX_SECRET_LENGTH:
+            raise ValueError(f"Secret too long: {len(secret)} bytes")
+        buffer = bytearray()
+        if op != JOURNAL_DELETE:
+            _pack_names(buffer, site, username)
+        names = self._sealer.seal(buffer, self._associated(op, index))
+        offset = self._end
+        self._file.seek(offset)
+        crc = 0
+        for data in (struct.pack(JOURNAL_RECORD_FORMAT, op, index, len(names), len(secret)), names, secret):
+            self._file.write(data)
+            crc = binascii.crc32(data, crc)
+        self._file.write(struct.pack(CRC_FORMAT, crc))
+        self._file.flush()
+        self._end = offset + JOURNAL_RECORD_SIZE + len(names) + len(secret) + CRC_SIZE
+        self.count += 1
+        return offset
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class PasswordEntries:
+    """
+    List-like view of the vault and its journal that only decrypts a
+    password when its entry is read. Recently used plaintexts are kept in
+    a small LRU so scrolling back and forth does not re-run AES, wipe()
+    drops them.
+
+    Entries are tracked as references in an array: n >= 0 is record n of
+    the vault file, a negative value is the journal record at offset
+    -n - 1. Site and username names are decrypted once when the vault is
+    opened and kept packed in a NameTable for the session.
+
+    search() uses an array of name codes (entry index << 1, low bit set
+    for the username) sorted by lowercased name. It is built in RAM on
+    first use after unlocking and never written to flash.
+
+    key is the key derived from the unlock pattern. It only unwraps the
+    data key from the vault header, which seals everything else through
+    sealer. Records for compact() come from seal_records(sealer, rows).
+    """
+
+    def __init__(self, key, path=VAULT_FILE, journal_path=JOURNAL_FILE, cache_size=PLAINTEXT_CACHE_SIZE):
+        self._pattern_key = key
+        self._key = None
+        self._wrapped_key = None
+        self.sealer = None
+        self._path = path
+        self._journal_path = journal_path
+        self._cache_size = cache_size
+        self._cache = {}
+        self._order = []
+        self._reader = None
+        self._journal = None
+        self._names = NameTable()
+        self._index = None
+        self._open()
+
+    def _open(self):
+        self._reader = VaultReader(self._path)
+        try:
+            wrapped_key = self._reader.wrapped_key
+            if wrapped_key is None:
+                raise ValueError("Vault has no data key")
+            if self._key is None or wrapped_key != self._wrapped_key:
+                self._set_key(unwrap_key(self._pattern_key, wrapped_key))
+                self._wrapped_key = wrapped_key
+            names = self._reader.names(self.sealer)
+            self._journal = Journal(self._journal_path, self._reader.generation, self.sealer)
+            self._refs, self._names = self._journal.replay(array("l", range(len(self._reader))), names)
+        except Exception:
+            self._close_files()
+            raise
+        self.kdf_params = self._reader.kdf_params
+        if self._journal.torn:
+            print("Journal ends with a damaged record, compacting")
+            self.compact()
+
+    def _set_key(self, key):
+        self._key = key
+        self.sealer = Sealer(key)
+
+    def _close_files(self):
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+
+    def _secret(self, ref):
+        if ref >= 0:
+            return self._reader.secret(ref)
+        return self._journal.secret(-ref - 1)
+
+    def __len__(self):
+        if self._reader is None:
+            return 0
+        return len(self._refs)
+
+    def name(self, index):
+        """
+        Return (site, username) for an entry without decrypting it.
+        """
+        return self._names[index]
+
+    def _associated(self, index):
+        return RECORD_ASSOCIATED + self._names.packed(index)
+
+    def __getitem__(self, index):
+        ref = self._refs[index]
+        site, username = self._names[index]
+        password = self._cache.get(ref)
+        if password is None:
+            password = self._decrypt(index, self._secret(ref))
+            self._cache[ref] = password
+            if len(self._order) >= self._cache_size:
+                del self._cache[self._order.pop(0)]
+        else:
+            self._order.remove(ref)
+        self._order.append(ref)
+        return Entry(site, username, password)
+
+    def __iter__(self):
+        # Full walks (e.g. exports) bypass the LRU so they don't evict
+        # the entries the user is looking at
+        for indexes, secrets in self._batches():
+            try:
+                passwords = [bytes(password).decode() for password in self.sealer.open_batch(secrets, [self._associated(index) for index in indexes])]
+            except ValueError:
+                # Find and report the damaged entry one by one
+                passwords = [self._decrypt(index, secrets[index - indexes[0]]) for index in indexes]
+            for index in indexes:
+                site, username = self._names[index]
+                yield Entry(site, username, passwords[index - indexes[0]])
+
+    def _batches(self):
+        # (indexes, secrets) of every entry, CIPHER_BATCH_SIZE at a time
+        for start in range(0, len(self._refs), CIPHER_BATCH_SIZE):
+            indexes = range(start, min(start + CIPHER_BATCH_SIZE, len(self._refs)))
+            yield indexes, [self._secret(self._refs[index]) for index in indexes]
+
+    def _decrypt(self, index, secret):
+        try:
+            return self.sealer.open(secret, self._associated(index)).decode()
+        except ValueError as e:
+            print(f"Failed to decrypt password for {self._names[index][0]}: {e}")
+            return ""
+
+    def verify(self):
+        """
+        Return the indexes of entries whose record fails authentication.
+        Checks one MAC per entry, nothing is decrypted.
+        """
+        return [index for index, ref in enumerate(self._refs) if not self.sealer.verify(self._secret(ref), self._associated(index))]
+
+    def _forget(self, ref):
+        if ref in self._cache:
+            del self._cache[ref]
+            self._order.remove(ref)
+        self._index = None
+
+    def _build_index(self):
+        # The codes are sorted in place, so the index never costs more
+        # than its array. Names are compared by a prefix of their key
+        # computed once per code, the keys are only read from the
+        # NameTable again when the prefixes are equal.
+        index = array("L")
+        prefixes = array("L")
+        for entry in range(len(self._names)):
+            for code in (entry << 1, entry << 1 | 1):
+                prefixes.append(_sort_prefix(self._code_key(code)))
+            index.append(entry << 1)
+            if self._names.has_username(entry):
+                index.append(entry << 1 | 1)
+
+        def less(a, b):
+            if prefixes[a] != prefixes[b]:
+                return prefixes[a] < prefixes[b]
+            a_key = self._code_key(a)
+            b_key = self._code_key(b)
+            if a_key != b_key:
+                return a_key < b_key
+            return a < b
+
+        _heapsort(index, less)
+        self._index = index
+
+    def _code_key(self, code):
+        # Names sort by their UTF-8 bytes with ASCII letters lowercased,
+        # the same order as str.lower() for the ASCII names the device
+        # shows, without decoding anything
+        return self._names.encoded(code >> 1, code & 1).lower()
+
+    def _index_key(self, position):
+        return self._code_key(self._index[position])
+
+    def search(self, prefix, limit=None):
+        """
+        Return (matches, hits): up to limit entry indexes whose site or
+        username starts with prefix in name order, and the total number of
+        matching names. Two binary searches bound the matching range.
+        """
+        if self._index is None:
+            self._build_index()
+        count = len(self._index)
+        prefix = prefix.encode().lower()
+        start = _lower_bound(self._index_key, count, prefix)
+        if prefix:
+            end = _lower_bound(self._index_key, count, prefix[:-1] + bytes((prefix[-1] + 1,)))
+        else:
+            end = count
+
+        matches = []
+        for position in range(start, end):
+            index = self._index[position] >> 1
+            if index not in matches:
+                matches.append(index)
+                if limit is not None and len(matches) >= limit:
+                    break
+        return matches, end - start
+
+    def find(self, site, username):
+        """
+        Return the index of the entry named exactly site and username, or
+        None. The site is looked up in the search index.
+        """
+        if self._index is None:
+            self._build_index()
+        site = site.encode()
+        username = username.encode()
+        key = site.lower()
+        position = _lower_bound(self._index_key, len(self._index), key)
+        while position < len(self._index) and self._index_key(position) == key:
+            code = self._index[position]
+            if not code & 1 and self._names.encoded(code >> 1, 0) == site and self._names.encoded(code >> 1, 1) == username:
+                return code >> 1
+            position += 1
+        return None
+
+    def add(self, site, username, password):
+        secret = self.sealer.seal(password.encode(), _record_associated(site, username))
+        offset = self._journal.append(JOURNAL_ADD, len(self._refs), site, username, secret)
+        self._refs.append(-offset - 1)
+        self._names.append((site, username))
+        self._index = None
+
+    def update(self, index, site, username, password):
+        secret = self.sealer.seal(password.encode(), _record_associated(site, username))
+        offset = self._journal.append(JOURNAL_UPDATE, index, site, username, secret)
+        self._forget(self._refs[index])
+        self._refs[index] = -offset - 1
+        self._names[index] = (site, username)
+
+    def delete(self, index):
+        self._journal.append(JOURNAL_DELETE, index)
+        self._forget(self._refs[index])
+        self._refs = _remove_at(self._refs, index)
+        self._names.pop(index)
+
+    def flush(self):
+        """
+        Fold pending journal records into the vault file, so the file on
+        its own holds every entry.
+        """
+        if self._journal.count:
+            self.compact()
+
+    def needs_compaction(self):
+        return self._journal.count >= JOURNAL_COMPACT_THRESHOLD
+
+    def _records(self):
+        for index, ref in enumerate(self._refs):
+            site, username = self._names[index]
+            yield site, username, self._secret(ref)
+
+    def compact(self, extra=()):
+        """
+        Fold the journal into a fresh vault file, followed by any
+        (site, username, secret) records from seal_records() in the
+        iterable extra. Passwords are copied as ciphertext, only the names
+        blob is sealed again.
+        """
+        def records():
+            yield from self._records()
+            yield from extra
+
+        self._rewrite(records(), self.kdf_params, self._wrapped_key)
+
+    def rekey(self, key, kdf_params):
+        """
+        Make key, derived with kdf_params, the pattern key of the vault.
+        Only the data key is wrapped again and the new parameters recorded
+        in the header, passwords are copied as ciphertext like compact().
+        """
+        self._rewrite(self._records(), kdf_params, wrap_key(key, self._key))
+        self._pattern_key = key
+
+    def _rewrite(self, records, kdf_params, wrapped_key):
+        temp_path = self._path + ".tmp"
+        generation = self._reader.generation + 1
+        with VaultWriter(temp_path, generation, self.sealer, kdf_params, wrapped_key) as writer:
+            for site, username, secret in records:
+                writer.add(site, username, secret)
+        self._close_files()
+        _install_vault(temp_path, self._path, self._journal_path, generation)
+        self._wrapped_key = wrapped_key
+        self._cache.clear()
+        self._order = []
+        self._names.clear()
+        self._index = None
+        self._open()
+
+    def wipe(self):
+        self._cache.clear()
+        self._order = []
+        self._refs = array("l")
+        self._names.clear()
+        self._index = None
+        self._key = None
+        self._pattern_key = None
+        self._wrapped_key = None
+        self.sealer = None
+        self._close_files()
+
+
+def restore_vault(file, length, path=VAULT_FILE, journal_path=JOURNAL_FILE):
+    """
+    Install the vault image of length bytes read from file as the next
+    generation after the current vault. The image is streamed to a
+    temporary file and checked against its own checksum on the way, the
+    previous vault is kept as path.old. Returns the new generation.
+    """
+    header = _read_header(file)[-1]
+    remaining = length - len(header) - CRC_SIZE
+    if remaining < 0:
+        raise ValueError("Truncated vault image")
+
+    generation = vault_generation(path) + 1
+    temp_path = path + ".tmp"
+    try:
+        with open(temp_path, "wb") as out:
+            out.write(bytes(len(header)))
+            buffer = bytearray(256)
+            view = memoryview(buffer)
+            crc = 0
+            while remaining:
+                read = file.readinto(view[:min(remaining, len(buffer))])
+                if not read:
+                    raise ValueError("Truncated vault image")
+                out.write(view[:read])
+                crc = binascii.crc32(view[:read], crc)
+                remaining -= read
+            stored = struct.unpack(CRC_FORMAT, file.read(CRC_SIZE))[0]
+            if binascii.crc32(header, crc) != stored:
+                raise ValueError("Vault image checksum mismatch")
+            # Only the generation changes, so the body checksum carries over
+            header = bytearray(header)
+            struct.pack_into("<I", header, GENERATION_OFFSET, generation)
+            out.write(struct.pack(CRC_FORMAT, binascii.crc32(header, crc)))
+            out.seek(0)
+            out.write(header)
+    except Exception:
+        os.remove(temp_path)
+        raise
+    _install_vault(temp_path, path, journal_path, generation)
+    return generation
+
+
+def write_vault(records, path=VAULT_FILE, generation=1, key=None, kdf_params=None, wrapped_key=None):
+    with VaultWriter(path, generation, Sealer(key), kdf_params, wrapped_key) as writer:
+        for site, username, secret in records:
+            writer.add(site, username, secret)
+        return writer.count
+
+
+def commit_vault(records, key, wrapped_key, path=VAULT_FILE, journal_path=JOURNAL_FILE, kdf_params=None):
+    """
+    Replace the vault with records from seal_records() under the data key
+    key, stored as wrapped_key, and clear the journal. The new generation
+    is written to a temporary file and checksummed before it is renamed
+    into place.
+    """
+    temp_path = path + ".tmp"
+    generation = vault_generation(path) + 1
+    count = write_vault(records, temp_path, generation, key, kdf_params, wrapped_key)
+    _install_vault(temp_path, path, journal_path, generation)
+    return count
+
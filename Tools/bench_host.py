@@ -0,0 +1,99 @@
+"""
+Run the encryption benchmarks in Code/bench.py on a PC.
+
+Code/ is imported with the stand-ins in Tools/host for the CircuitPython
+modules it needs (aesio, micropython). Unless --native-hash is given,
+CPython's hashlib is hidden while adafruit_hashlib loads, so HMAC and
+PBKDF2 run on the same pure-Python engines as on the device.
+
+CPython keeps no running total of allocated bytes, so the last column is
+peak_bytes, the tracemalloc peak of one call above what was traced before
+it. On the device it is alloc_bytes, the growth of gc.mem_alloc() with the
+collector off, which also counts memory a call frees again. The two are
+not comparable. Otherwise the CSV is the one bench.main() prints over
+serial, --compare takes such a capture (REPL noise around it is skipped)
+and adds the host/device speed ratio.
+
+    python Tools/bench_host.py --min-time 200 --compare rp2040.txt
+"""
+import argparse
+import os
+import sys
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(ROOT, "Tools", "host"), os.path.join(ROOT, "Code"), os.path.join(ROOT, "Code", "lib")]
+
+
+def load_bench(native_hash):
+    if native_hash:
+        import bench
+        return bench
+    hashlib = sys.modules.get("hashlib")
+    sys.modules["hashlib"] = None  # Makes adafruit_hashlib fall back to its own engines
+    try:
+        import bench
+    finally:
+        if hashlib is None:
+            del sys.modules["hashlib"]
+        else:
+            sys.modules["hashlib"] = hashlib
+    return bench
+
+
+def tracemalloc_peak(fn):
+    # Tracing slows every allocation down, so it only runs for this call
+    tracemalloc.start()
+    try:
+        current, _ = tracemalloc.get_traced_memory()
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak - current
+
+
+def read_results(path):
+    """Map (name, param) to ops/s for the CSV rows in a captured run."""
+    results = {}
+    with open(path, encoding="utf-8", errors="replace") as file:
+        for line in file:
+            fields = line.strip().split(",")
+            if len(fields) != 7:
+                continue
+            try:
+                results[fields[0], int(fields[1])] = float(fields[4])
+            except ValueError:
+                continue
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--min-time", type=int, default=200, help="milliseconds each case runs for (default 200)")
+    parser.add_argument("--only", nargs="+", metavar="NAME", help="run only these cases")
+    parser.add_argument("--native-hash", action="store_true", help="use CPython's hashlib instead of the pure-Python engines")
+    parser.add_argument("--compare", metavar="FILE", help="bench output captured on the device")
+    args = parser.parse_args()
+
+    bench = load_bench(args.native_hash)
+    reference = read_results(args.compare) if args.compare else None
+
+    def report(line):
+        if reference is not None and not line.startswith("#"):
+            if line.startswith(bench.CSV_COLUMNS + ","):
+                line += ",device_ops_per_s,speedup"
+            else:
+                fields = line.split(",")
+                device = reference.get((fields[0], int(fields[1])))
+                if device:
+                    line += f",{device:.2f},{float(fields[4]) / device:.1f}"
+                else:
+                    line += ",,"
+        print(line, flush=True)
+
+    bench.run(args.min_time, set(args.only) if args.only else None, tracemalloc_peak, report, "peak_bytes")
+
+
+if __name__ == "__main__":
+    main()
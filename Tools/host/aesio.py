@@ -0,0 +1,186 @@
+"""
+Pure-Python stand-in for CircuitPython's aesio, used to run Code/ on a PC.
+
+Follows the aesio API and its quirks that the firmware relies on: the
+CBC chain and the CTR counter carry over between calls, and every CTR
+call starts on a fresh keystream block like the tiny-AES code behind
+aesio, so callers must feed CTR in multiples of 16 bytes except at the
+end of a message. It is slow and not constant-time, and only exists so
+that host runs and benchmarks exercise the same code paths as the
+device.
+"""
+
+MODE_ECB = 1
+MODE_CBC = 2
+MODE_CTR = 6
+
+_BLOCK = 16
+
+
+def _xtime(a):
+    a <<= 1
+    return (a ^ 0x11B) if a & 0x100 else a
+
+
+def _mul(a, b):
+    result = 0
+    while b:
+        if b & 1:
+            result ^= a
+        a = _xtime(a)
+        b >>= 1
+    return result
+
+
+def _make_sbox():
+    sbox = bytearray(256)
+    inverse = bytearray(256)
+    for x in range(256):
+        # Multiplicative inverse in GF(2^8), then the affine transform
+        y = 0
+        if x:
+            y = 1
+            while _mul(x, y) != 1:
+                y += 1
+        s = y
+        for shift in range(1, 5):
+            s ^= ((y << shift) | (y >> (8 - shift))) & 0xFF
+        s ^= 0x63
+        sbox[x] = s
+        inverse[s] = x
+    return bytes(sbox), bytes(inverse)
+
+
+_SBOX, _INV_SBOX = _make_sbox()
+_MUL2 = bytes(_mul(x, 2) for x in range(256))
+_MUL3 = bytes(_mul(x, 3) for x in range(256))
+_MUL9 = bytes(_mul(x, 9) for x in range(256))
+_MUL11 = bytes(_mul(x, 11) for x in range(256))
+_MUL13 = bytes(_mul(x, 13) for x in range(256))
+_MUL14 = bytes(_mul(x, 14) for x in range(256))
+
+
+def _expand_key(key):
+    if len(key) not in (16, 24, 32):
+        raise ValueError("Key length must be 16, 24, or 32 bytes")
+    words = len(key) // 4
+    rounds = words + 6
+    schedule = list(key)
+    rcon = 1
+    for i in range(words, 4 * (rounds + 1)):
+        temp = schedule[-4:]
+        if i % words == 0:
+            temp = [_SBOX[temp[1]] ^ rcon, _SBOX[temp[2]], _SBOX[temp[3]], _SBOX[temp[0]]]
+            rcon = _xtime(rcon)
+        elif words > 6 and i % words == 4:
+            temp = [_SBOX[b] for b in temp]
+        start = len(schedule) - 4 * words
+        schedule.extend(schedule[start + j] ^ temp[j] for j in range(4))
+    return [bytes(schedule[16 * r:16 * r + 16]) for r in range(rounds + 1)]
+
+
+def _encrypt_block(round_keys, block):
+    s = [b ^ k for b, k in zip(block, round_keys[0])]
+    last = len(round_keys) - 1
+    for r in range(1, last + 1):
+        s = [_SBOX[b] for b in s]
+        # ShiftRows, the state is stored column by column
+        s = [s[(i + 4 * (i % 4)) % 16] for i in range(16)]
+        if r != last:
+            mixed = []
+            for c in range(0, 16, 4):
+                a0, a1, a2, a3 = s[c:c + 4]
+                mixed += [
+                    _MUL2[a0] ^ _MUL3[a1] ^ a2 ^ a3,
+                    a0 ^ _MUL2[a1] ^ _MUL3[a2] ^ a3,
+                    a0 ^ a1 ^ _MUL2[a2] ^ _MUL3[a3],
+                    _MUL3[a0] ^ a1 ^ a2 ^ _MUL2[a3],
+                ]
+            s = mixed
+        s = [b ^ k for b, k in zip(s, round_keys[r])]
+    return bytes(s)
+
+
+def _decrypt_block(round_keys, block):
+    last = len(round_keys) - 1
+    s = [b ^ k for b, k in zip(block, round_keys[last])]
+    for r in range(last - 1, -1, -1):
+        s = [s[(i - 4 * (i % 4)) % 16] for i in range(16)]
+        s = [_INV_SBOX[b] for b in s]
+        s = [b ^ k for b, k in zip(s, round_keys[r])]
+        if r:
+            mixed = []
+            for c in range(0, 16, 4):
+                a0, a1, a2, a3 = s[c:c + 4]
+                mixed += [
+                    _MUL14[a0] ^ _MUL11[a1] ^ _MUL13[a2] ^ _MUL9[a3],
+                    _MUL9[a0] ^ _MUL14[a1] ^ _MUL11[a2] ^ _MUL13[a3],
+                    _MUL13[a0] ^ _MUL9[a1] ^ _MUL14[a2] ^ _MUL11[a3],
+                    _MUL11[a0] ^ _MUL13[a1] ^ _MUL9[a2] ^ _MUL14[a3],
+                ]
+            s = mixed
+    return bytes(s)
+
+
+class AES:
+    """
+    AES cipher in ECB, CBC or CTR mode with the aesio interface.
+    """
+
+    def __init__(self, key, mode=MODE_ECB, IV=None, segment_size=8):
+        if mode not in (MODE_ECB, MODE_CBC, MODE_CTR):
+            raise NotImplementedError("Requested mode is not supported")
+        self.mode = mode
+        self.rekey(key, IV)
+
+    def rekey(self, key, IV=None):
+        self._round_keys = _expand_key(bytes(key))
+        if IV is None:
+            IV = bytes(_BLOCK)
+        if len(IV) != _BLOCK:
+            raise ValueError("IV must be 16 bytes long")
+        self._iv = bytes(IV)
+
+    def _check(self, src, dest):
+        if len(src) != len(dest):
+            raise ValueError("Source and dest buffers must be the same length")
+        if self.mode == MODE_ECB and len(src) != _BLOCK:
+            raise ValueError("ECB mode requires exactly 16 bytes")
+        if self.mode == MODE_CBC and len(src) % _BLOCK:
+            raise ValueError("CBC mode requires a multiple of 16 bytes")
+
+    def _ctr(self, src, dest):
+        counter = int.from_bytes(self._iv, "big")
+        for offset in range(0, len(src), _BLOCK):
+            keystream = _encrypt_block(self._round_keys, counter.to_bytes(_BLOCK, "big"))
+            counter = (counter + 1) & ((1 << 128) - 1)
+            chunk = src[offset:offset + _BLOCK]
+            dest[offset:offset + len(chunk)] = bytes(a ^ b for a, b in zip(chunk, keystream))
+        self._iv = counter.to_bytes(_BLOCK, "big")
+
+    def encrypt_into(self, src, dest):
+        self._check(src, dest)
+        src = bytes(src)
+        if self.mode == MODE_CTR:
+            self._ctr(src, dest)
+        elif self.mode == MODE_ECB:
+            dest[:] = _encrypt_block(self._round_keys, src)
+        else:
+            for offset in range(0, len(src), _BLOCK):
+                block = bytes(a ^ b for a, b in zip(src[offset:offset + _BLOCK], self._iv))
+                self._iv = _encrypt_block(self._round_keys, block)
+                dest[offset:offset + _BLOCK] = self._iv
+
+    def decrypt_into(self, src, dest):
+        self._check(src, dest)
+        src = bytes(src)
+        if self.mode == MODE_CTR:
+            self._ctr(src, dest)
+        elif self.mode == MODE_ECB:
+            dest[:] = _decrypt_block(self._round_keys, src)
+        else:
+            for offset in range(0, len(src), _BLOCK):
+                block = src[offset:offset + _BLOCK]
+                plain = _decrypt_block(self._round_keys, block)
+                dest[offset:offset + _BLOCK] = bytes(a ^ b for a, b in zip(plain, self._iv))
+                self._iv = block
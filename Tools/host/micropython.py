@@ -0,0 +1,8 @@
+"""
+Stand-in for the micropython module on a PC, only const() is used by
+the pure-Python hash engines in adafruit_hashlib.
+"""
+
+
+def const(value):
+    return value
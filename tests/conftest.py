@@ -0,0 +1,32 @@
+"""
+Host tests for the firmware in Code/. The CircuitPython modules it needs
+come from the stand-ins in Tools/host, and CPython's hashlib is hidden
+while adafruit_hashlib loads, so HMAC and PBKDF2 run on the same
+pure-Python engines as on the device.
+"""
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Appended, not prepended: Code/code.py would shadow the code module that
+# pytest's debugger imports
+sys.path += [os.path.join(ROOT, "Tools", "host"), os.path.join(ROOT, "Code"), os.path.join(ROOT, "Code", "lib")]
+
+_hashlib = sys.modules.get("hashlib")
+sys.modules["hashlib"] = None
+try:
+    import encryption  # noqa: F401
+finally:
+    if _hashlib is None:
+        del sys.modules["hashlib"]
+    else:
+        sys.modules["hashlib"] = _hashlib
+
+
+@pytest.fixture(autouse=True)
+def workdir(tmp_path, monkeypatch):
+    # The vault files are named relative to the drive root
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
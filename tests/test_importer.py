@@ -0,0 +1,41 @@
+import io
+
+import pytest
+
+from encryption import KDF_PBKDF2_SHA256, derive_key, new_data_key, wrap_key
+from importer import import_csv, read_entries
+from vault import PasswordEntries, commit_vault
+
+PARAMS = (KDF_PBKDF2_SHA256, 10, bytes(16))
+
+
+def entries_of(text, chunk_size=7):
+    return list(read_entries(io.BytesIO(text.encode()), chunk_size))
+
+
+def test_rows_without_header():
+    assert entries_of("a,u,p1\nb,,p2\nc,u\n") == [("a", "u", "p1"), ("b", "", "p2")]
+
+
+def test_keepass_header_and_quoting():
+    text = '\ufeff"Title","User Name","Password","URL"\r\n"Bank, inc","me","p""w\nx",""\r\n'
+    assert entries_of(text) == [("Bank, inc", "me", 'p"w\nx')]
+
+
+def test_header_without_password_column_is_rejected():
+    with pytest.raises(ValueError):
+        entries_of("site,username\na,b\n")
+
+
+def test_import_skips_entries_in_the_vault(tmp_path):
+    key = derive_key(["up", "down"] * 4, PARAMS[2], PARAMS[1], PARAMS[0])
+    data_key = new_data_key()
+    commit_vault([], data_key, wrap_key(key, data_key), kdf_params=PARAMS)
+    entries = PasswordEntries(key)
+    entries.add("a", "u", "old")
+    path = tmp_path / "passwords.csv"
+    path.write_text("site,username,password\na,u,new\nb,u,1\nb,u,2\n")
+
+    assert import_csv(entries, str(path)) == 2
+    assert [(entry.site, entry.username, entry.password) for entry in entries] == [("a", "u", "old"), ("b", "u", "1"), ("b", "u", "2")]
+    entries.wipe()
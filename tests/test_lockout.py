@@ -0,0 +1,73 @@
+import os
+
+import pytest
+
+from lockout import LOCKOUT_BASE_DELAY, LOCKOUT_FILE, LOCKOUT_FREE_ATTEMPTS, LOCKOUT_MAX_DELAY, begin_attempt, end_attempt, lockout_delay, next_attempt_time
+from vault import VAULT_FILE
+
+NOW = 1000000
+
+
+@pytest.fixture
+def vault():
+    with open(VAULT_FILE, "wb") as file:
+        file.write(b"vault")
+    # Unlocking the new vault writes the first state
+    end_attempt()
+
+
+def fail(times, now=NOW):
+    for _ in range(times):
+        begin_attempt(now)
+
+
+def test_delay_doubles_up_to_the_limit():
+    assert [lockout_delay(failures) for failures in range(LOCKOUT_FREE_ATTEMPTS + 3)] == [0] * LOCKOUT_FREE_ATTEMPTS + [LOCKOUT_BASE_DELAY, LOCKOUT_BASE_DELAY * 2, LOCKOUT_BASE_DELAY * 4]
+    assert lockout_delay(1000) == LOCKOUT_MAX_DELAY
+
+
+def test_no_delay_before_the_first_vault():
+    assert next_attempt_time(NOW) == 0
+
+
+def test_failures_delay_and_success_clears(vault):
+    fail(LOCKOUT_FREE_ATTEMPTS - 1)
+    assert next_attempt_time(NOW) == 0
+    fail(2)
+    assert next_attempt_time(NOW) == NOW + LOCKOUT_BASE_DELAY * 2
+    # An attempt that never ended counts as failed
+    begin_attempt(NOW)
+    assert next_attempt_time(NOW) == NOW + LOCKOUT_BASE_DELAY * 4
+    begin_attempt(NOW)
+    end_attempt()
+    assert os.path.exists(LOCKOUT_FILE)
+    assert next_attempt_time(NOW) == 0
+
+
+def test_clock_set_back_restarts_the_delay(vault):
+    fail(LOCKOUT_FREE_ATTEMPTS)
+    earlier = NOW - 5000
+    assert next_attempt_time(earlier) == earlier + LOCKOUT_BASE_DELAY
+    assert next_attempt_time(NOW) == earlier + LOCKOUT_BASE_DELAY
+
+
+@pytest.mark.parametrize("damage", ["delete", "truncate"])
+def test_damaged_file_does_not_lift_the_delay(vault, damage):
+    fail(LOCKOUT_FREE_ATTEMPTS + 1)
+    if damage == "delete":
+        os.remove(LOCKOUT_FILE)
+    else:
+        with open(LOCKOUT_FILE, "r+b") as file:
+            file.truncate(3)
+    later = NOW + 10
+    assert next_attempt_time(later) == later + LOCKOUT_BASE_DELAY
+    # The delay runs from when the damage was noticed, not from each check
+    assert next_attempt_time(later + 20) == later + LOCKOUT_BASE_DELAY
+    fail(1, later + LOCKOUT_BASE_DELAY)
+    assert next_attempt_time(later + LOCKOUT_BASE_DELAY) == later + LOCKOUT_BASE_DELAY * 3
+
+
+def test_state_survives_in_the_temporary_file(vault):
+    fail(LOCKOUT_FREE_ATTEMPTS)
+    os.rename(LOCKOUT_FILE, LOCKOUT_FILE + ".tmp")
+    assert next_attempt_time(NOW) == NOW + LOCKOUT_BASE_DELAY
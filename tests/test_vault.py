@@ -0,0 +1,134 @@
+import os
+
+import pytest
+
+from encryption import KDF_PBKDF2_SHA256, derive_key, new_data_key, wrap_key
+from vault import JOURNAL_FILE, JOURNAL_HEADER_SIZE, VAULT_FILE, PasswordEntries, commit_vault, read_kdf_params, recover_vault, vault_generation
+
+PARAMS = (KDF_PBKDF2_SHA256, 10, bytes(16))
+
+
+def pattern_key(pattern, params=PARAMS):
+    return derive_key(pattern, params[2], params[1], params[0])
+
+
+@pytest.fixture
+def key():
+    key = pattern_key(["up", "down"] * 4)
+    data_key = new_data_key()
+    commit_vault([], data_key, wrap_key(key, data_key), kdf_params=PARAMS)
+    return key
+
+
+def passwords(entries):
+    return [(entry.site, entry.username, entry.password) for entry in entries]
+
+
+def test_round_trip(key):
+    entries = PasswordEntries(key)
+    for i in range(20):
+        entries.add(f"site{i}", f"user{i}", f"pw{i}")
+    entries.update(0, "zero", "user0", "changed")
+    entries.delete(3)
+    expected = passwords(entries)
+    entries.wipe()
+
+    entries = PasswordEntries(key)
+    assert passwords(entries) == expected
+    assert entries[0].password == "changed"
+    assert entries.find("site4", "user4") == 3
+    entries.flush()
+    entries.wipe()
+
+    entries = PasswordEntries(key)
+    assert os.path.getsize(JOURNAL_FILE) == JOURNAL_HEADER_SIZE
+    assert passwords(entries) == expected
+    assert entries.verify() == []
+    entries.wipe()
+
+
+def test_wrong_key_is_rejected(key):
+    with pytest.raises(ValueError):
+        PasswordEntries(pattern_key(["up", "down"] * 3 + ["up", "up"]))
+
+
+def test_torn_journal_keeps_earlier_records(key):
+    entries = PasswordEntries(key)
+    entries.add("a", "u", "1")
+    entries.add("b", "u", "2")
+    entries.add("c", "u", "3")
+    entries.wipe()
+    with open(JOURNAL_FILE, "r+b") as file:
+        file.truncate(os.path.getsize(JOURNAL_FILE) - 3)
+
+    generation = vault_generation()
+    entries = PasswordEntries(key)
+    assert passwords(entries) == [("a", "u", "1"), ("b", "u", "2")]
+    # The damaged tail is compacted away right after opening
+    assert vault_generation() == generation + 1
+    assert os.path.getsize(JOURNAL_FILE) == JOURNAL_HEADER_SIZE
+    entries.wipe()
+
+
+def test_recover_from_tmp(key):
+    entries = PasswordEntries(key)
+    entries.add("a", "u", "1")
+    entries.flush()
+    generation = vault_generation()
+    entries.wipe()
+    # Power lost after the old vault was moved aside but before the new
+    # one was renamed into place
+    os.rename(VAULT_FILE, VAULT_FILE + ".tmp")
+
+    assert recover_vault() == generation
+    assert not os.path.exists(VAULT_FILE + ".tmp")
+    entries = PasswordEntries(key)
+    assert passwords(entries) == [("a", "u", "1")]
+    entries.wipe()
+
+
+def test_recover_ignores_damaged_tmp(key):
+    generation = vault_generation()
+    with open(VAULT_FILE, "rb") as file:
+        data = bytearray(file.read())
+    data[-1] ^= 1
+    with open(VAULT_FILE + ".tmp", "wb") as file:
+        file.write(data)
+
+    assert recover_vault() == generation
+    PasswordEntries(key).wipe()
+
+
+def test_rekey(key):
+    entries = PasswordEntries(key)
+    entries.add("a", "u", "1")
+    entries.add("b", "u", "2")
+    params = (KDF_PBKDF2_SHA256, 12, bytes(range(16)))
+    new_key = pattern_key(["left", "right"] * 4, params)
+    entries.rekey(new_key, params)
+    entries.wipe()
+
+    assert read_kdf_params() == params
+    with pytest.raises(ValueError):
+        PasswordEntries(key)
+    entries = PasswordEntries(new_key)
+    assert passwords(entries) == [("a", "u", "1"), ("b", "u", "2")]
+    entries.wipe()
+
+
+def test_search_index(key):
+    entries = PasswordEntries(key)
+    names = [("GitHub", "me@example.com"), ("gitlab", "me@example.com"), ("Google", ""), ("git", "Work"), ("bank", "github-bot"), ("GitHub", "other")]
+    for site, username in names:
+        entries.add(site, username, "pw")
+
+    matches, hits = entries.search("GIT")
+    assert matches == [3, 0, 5, 4, 1]
+    assert hits == 5
+    assert entries.search("me@", limit=1) == ([0], 2)
+    assert entries.search("x") == ([], 0)
+    assert entries.find("GitHub", "other") == 5
+    assert entries.find("github", "other") is None
+    entries.delete(0)
+    assert entries.find("GitHub", "other") == 4
+    entries.wipe()